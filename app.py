@@ -1,27 +1,315 @@
 """
 Flask application for converting multiple Markdown files to a combined Word document.
+
+The python-docx stack is only imported by the first Word conversion (or at
+startup with PRELOAD_CONVERTER=true), so workers come up quickly and health
+probes, rejected uploads and HTML or ODT conversions never pay for it.
 """
 
+import time
+
+_import_started = time.perf_counter()
+
 import os
+import shutil
 import tempfile
+import threading
+import zipfile
+from functools import partial
 from flask import Flask, request, render_template, send_file, flash, redirect, url_for
 from werkzeug.utils import secure_filename
-from converter import MarkdownToWordConverter
+from conversion_cache import DiskCache, content_hash
+from images import is_image_file
+from ingest import FragmentSpool, MarkdownUpload, ResourceUpload, ZipUpload, receive_uploads
+from jobs import DONE, JobQueue
+from metrics import ConversionStats, Metrics
+from writers import OUTPUT_FORMATS, WRITER_VERSION, HtmlWriter, OdtWriter
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 
 ALLOWED_EXTENSIONS = {'md'}
-MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max total upload size
+MAX_CONTENT_LENGTH = 512 * 1024 * 1024  # 512MB max total upload size
 
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
+# Outputs up to this size are built and served from memory, larger ones
+# spill to a temporary file
+app.config['SPOOL_MAX_BYTES'] = int(os.environ.get('SPOOL_MAX_BYTES', 8 * 1024 * 1024))
+
+# Limits for .zip uploads: number of entries and total uncompressed size
+app.config['MAX_ZIP_MEMBERS'] = int(os.environ.get('MAX_ZIP_MEMBERS', 10000))
+app.config['MAX_ZIP_SIZE'] = int(os.environ.get('MAX_ZIP_SIZE', 1024 * 1024 * 1024))
+
+# Content types of downloads by file extension; several formats are sent as
+# a zip archive
+DOWNLOAD_MIMETYPES = {f.extension: f.mimetype for f in OUTPUT_FORMATS.values()}
+DOWNLOAD_MIMETYPES['zip'] = 'application/zip'
+
+# Stream each converted file into the output package instead of building
+# the whole document tree in memory
+app.config['STREAMING_OUTPUT'] = os.environ.get('STREAMING_OUTPUT', 'true').lower() == 'true'
+
+# Number of processes used to convert files in parallel (0 = convert in-request)
+app.config['CONVERT_WORKERS'] = int(os.environ.get('CONVERT_WORKERS', 0))
+
+# Seconds of CPU time each markdown file may take to parse and build before
+# the rest of it is rendered as plain text (0 = unlimited)
+app.config['CONVERT_CPU_BUDGET'] = float(os.environ.get('CONVERT_CPU_BUDGET', 20))
+
+# Seconds of CPU time all markdown files of a request may take together to
+# parse and build; files are cut short once it has run out (0 = unlimited)
+app.config['CONVERT_REQUEST_CPU_BUDGET'] = float(os.environ.get('CONVERT_REQUEST_CPU_BUDGET', 60))
+
+# Optional corporate .docx/.dotx template; it is parsed once per process
+app.config['DOCX_TEMPLATE'] = os.environ.get('DOCX_TEMPLATE') or None
+
+# Content-addressed cache of converted files (empty directory = disabled)
+app.config['FRAGMENT_CACHE_DIR'] = os.environ.get(
+    'FRAGMENT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'md2docx-fragments')
+)
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = int(
+    os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+)
+
+# Cache of complete output documents keyed on the uploaded file set (empty
+# directory = disabled, the default: it writes every output to disk)
+app.config['OUTPUT_CACHE_DIR'] = os.environ.get('OUTPUT_CACHE_DIR', '')
+app.config['OUTPUT_CACHE_MAX_BYTES'] = int(
+    os.environ.get('OUTPUT_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+)
+
+fragment_cache = None
+if app.config['FRAGMENT_CACHE_DIR']:
+    fragment_cache = DiskCache(
+        app.config['FRAGMENT_CACHE_DIR'], app.config['FRAGMENT_CACHE_MAX_BYTES']
+    )
+
+output_cache = None
+if app.config['OUTPUT_CACHE_DIR']:
+    output_cache = DiskCache(
+        app.config['OUTPUT_CACHE_DIR'], app.config['OUTPUT_CACHE_MAX_BYTES']
+    )
+
+# Background conversions requested with async=1
+app.config['JOB_DIR'] = os.environ.get(
+    'JOB_DIR', os.path.join(tempfile.gettempdir(), 'md2docx-jobs')
+)
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_TTL'] = int(os.environ.get('JOB_TTL', 3600))
+
+job_queue = JobQueue(app.config['JOB_DIR'], app.config['JOB_WORKERS'], app.config['JOB_TTL'])
+
+# Pygments style for highlighting fenced code blocks that name their
+# language (empty = no highlighting)
+app.config['HIGHLIGHT_STYLE'] = os.environ.get('HIGHLIGHT_STYLE', 'default') or None
+
+# Import python-docx and parse the document template at startup instead of on
+# the first conversion, e.g. in a gunicorn --preload master before forking
+app.config['PRELOAD_CONVERTER'] = os.environ.get('PRELOAD_CONVERTER', 'false').lower() == 'true'
+
+# Per-process totals of conversions, served at /metrics
+conversion_metrics = Metrics()
+
+# Seconds spent importing the app and loading the converter, for /health
+startup_timings = {'app_import_s': None, 'converter_load_s': None}
+
+_converter_module = None
+# The process's ConverterEngine, shared by all request threads
+_converter_engine = None
+_converter_lock = threading.Lock()
+
+
+def load_converter():
+    """
+    Import the converter module and set up the shared conversion engine
+    (prewarming the document template) on first use; return the module.
+    """
+    global _converter_module, _converter_engine
+    if _converter_module is not None:
+        return _converter_module
+    with _converter_lock:
+        if _converter_module is None:
+            started = time.perf_counter()
+            import converter
+            from doc_template import get_template
+
+            if app.config['DOCX_TEMPLATE']:
+                template = get_template(app.config['DOCX_TEMPLATE'])
+            else:
+                template = get_template(setup=converter.setup_styles)
+            _converter_engine = converter.ConverterEngine(
+                cache=fragment_cache,
+                template=template,
+                highlight_style=app.config['HIGHLIGHT_STYLE'],
+                cpu_budget=app.config['CONVERT_CPU_BUDGET'] or None,
+            )
+            startup_timings['converter_load_s'] = time.perf_counter() - started
+            _converter_module = converter
+    return _converter_module
+
+
+def new_converter(stats):
+    """Create a converter for one Word render from the shared engine."""
+    load_converter()
+    return _converter_engine.converter(stats)
+
+
+class UploadedFiles(dict):
+    """Files uploaded along with the markdown, by their secured path."""
+
+    def get(self, path, default=None):
+        return super().get(secure_path(path), default)
+
+
+def secure_path(path):
+    """Secure every component of a relative path (e.g. a zip member's)."""
+    return '/'.join(filter(None, (secure_filename(part) for part in path.split('/'))))
+
 
 def allowed_file(filename):
     """Check if the file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def is_zip_file(filename):
+    """Check if the file is a zip archive."""
+    return filename.lower().endswith('.zip')
+
+
+def requested_formats(fields):
+    """
+    Return the output formats named by the 'format' query parameters and
+    form field (comma-separated), in order and without duplicates; docx if
+    none are.
+    """
+    formats = []
+    for value in request.args.getlist('format') + [fields.get('format', '')]:
+        for name in value.split(','):
+            name = name.strip().lower()
+            if name and name not in formats:
+                formats.append(name)
+    return formats or ['docx']
+
+
+def download_extension(formats):
+    """Return the file extension of the download for a list of formats."""
+    return OUTPUT_FORMATS[formats[0]].extension if len(formats) == 1 else 'zip'
+
+
+def output_key(markdown_contents, resource_hashes=(), formats=('docx',)):
+    """
+    Build the output cache key (and ETag) for a sorted list of markdown files,
+    the (name, hash) pairs of the files uploaded with them and the output
+    formats. Only Word output needs the converter loaded for it.
+    """
+    parts = [','.join(formats)]
+    if 'docx' in formats:
+        parts += [load_converter().FORMAT_VERSION, _converter_engine.fingerprint]
+    if formats != ['docx']:
+        parts += [WRITER_VERSION, app.config['HIGHLIGHT_STYLE'] or '']
+    for md_file in markdown_contents:
+        parts.append(md_file['filename'])
+        parts.append(md_file.get('hash') or content_hash(md_file['content']))
+    for name, digest in sorted(resource_hashes):
+        parts.append(name)
+        parts.append(digest)
+    return DiskCache.key(*parts)
+
+
+def write_format(stats, output_format, markdown_contents, output, resources=None,
+                 cpu_budget=None):
+    """
+    Write markdown files to a writable file object in one output format,
+    with what is left of the request's CPU budget in seconds.
+    """
+    if output_format == 'docx':
+        new_converter(stats).convert(
+            markdown_contents,
+            output,
+            streaming=app.config['STREAMING_OUTPUT'],
+            workers=app.config['CONVERT_WORKERS'],
+            resources=resources or None,
+            total_cpu_budget=cpu_budget,
+        )
+        return
+
+    highlight_style = app.config['HIGHLIGHT_STYLE']
+    if output_format == 'odt':
+        writer = OdtWriter(highlight_style, stats=stats)
+    else:
+        writer = HtmlWriter(highlight_style, print_ready=output_format == 'print-html', stats=stats)
+    writer.write(markdown_contents, output, resources or None)
+
+
+def build_document(stats, markdown_contents, output, etag, resources=None, formats=('docx',),
+                   cpu_budget=None):
+    """
+    Convert markdown files into a writable file object and cache the result.
+
+    Several formats are rendered from the same parsed blocks and bundled into
+    a zip archive. The conversion's stats are added to the /metrics totals.
+    Outputs partly rendered as plain text for lack of CPU budget are not
+    cached.
+    """
+    try:
+        if len(formats) == 1:
+            write_format(stats, formats[0], markdown_contents, output, resources, cpu_budget)
+        else:
+            with zipfile.ZipFile(output, 'w') as bundle:
+                for output_format in formats:
+                    with tempfile.SpooledTemporaryFile(max_size=app.config['SPOOL_MAX_BYTES']) as part:
+                        write_format(
+                            stats, output_format, markdown_contents, part, resources, cpu_budget
+                        )
+                        part.seek(0)
+                        info = zipfile.ZipInfo(
+                            'combined_document.' + OUTPUT_FORMATS[output_format].extension,
+                            time.localtime()[:6],
+                        )
+                        # Word and OpenDocument packages are compressed already
+                        if output_format not in ('docx', 'odt'):
+                            info.compress_type = zipfile.ZIP_DEFLATED
+                        with bundle.open(info, 'w') as target:
+                            shutil.copyfileobj(part, target)
+    except Exception:
+        conversion_metrics.observe(stats, failed=True)
+        raise
+    conversion_metrics.observe(stats)
+    degraded = stats.counts['degraded_sections'] or any(
+        md_file.get('degraded') for md_file in markdown_contents
+    )
+    if output_cache is not None and not degraded:
+        output_cache.put_fileobj(etag, output)
+
+
+def run_job(stats, markdown_contents, etag, resources, formats, cpu_budget, spool, output_path):
+    """Job body: build the document at output_path, then close the upload's spool."""
+    try:
+        with open(output_path, 'w+b') as output:
+            build_document(stats, markdown_contents, output, etag, resources, formats, cpu_budget)
+    finally:
+        spool.close()
+
+
+def send_output(path_or_file, etag, extension='docx'):
+    """Send a generated document (or zip of documents) as a download."""
+    return send_file(
+        path_or_file,
+        as_attachment=True,
+        download_name=f'combined_document.{extension}',
+        mimetype=DOWNLOAD_MIMETYPES[extension],
+        etag=etag,
+    )
+
+
+def add_timing_headers(response, stats):
+    """Report the stage timings and counts of a conversion on a response."""
+    response.headers['Server-Timing'] = stats.server_timing()
+    response.headers['X-Conversion-Counts'] = stats.counts_header()
+    return response
+
+
 @app.route('/', methods=['GET'])
 def index():
     """Render the upload form."""
@@ -31,66 +319,209 @@ def index():
 @app.route('/convert', methods=['POST'])
 def convert():
     """Handle file uploads and convert markdown files to Word document."""
-    if 'files' not in request.files:
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
         flash('No files selected', 'error')
         return redirect(url_for('index'))
 
-    files = request.files.getlist('files')
+    stats = ConversionStats()
+    spool = FragmentSpool(app.config['SPOOL_MAX_BYTES'])
+    # A background job takes the spool over and closes it when done
+    job_owns_spool = False
+    try:
+        markdown_contents = []
+        selected = []
+        # Images uploaded with the markdown, kept in the spool
+        resources = UploadedFiles()
+        resource_hashes = []
+        # Form fields, such as format and async
+        fields = {}
+        # The CPU budget shared by all files, on the thread CPU time clock
+        deadline = None
+        if app.config['CONVERT_REQUEST_CPU_BUDGET']:
+            deadline = time.thread_time() + app.config['CONVERT_REQUEST_CPU_BUDGET']
 
-    if not files or all(f.filename == '' for f in files):
-        flash('No files selected', 'error')
-        return redirect(url_for('index'))
+        def accept_member(path):
+            if allowed_file(path):
+                return MarkdownUpload(path, app.config['CONVERT_CPU_BUDGET'] or None, deadline)
+            if is_image_file(path):
+                return ResourceUpload(path)
+            return None
 
-    # Filter valid markdown files
-    valid_files = []
-    for file in files:
-        if file and file.filename and allowed_file(file.filename):
-            valid_files.append(file)
+        def accept_file(name, filename):
+            if name != 'files' or not filename:
+                return None
+            selected.append(filename)
+            if is_zip_file(filename):
+                # Members are extracted and parsed as the archive arrives
+                return ZipUpload(
+                    filename,
+                    accept_member,
+                    on_file,
+                    app.config['MAX_ZIP_MEMBERS'],
+                    app.config['MAX_ZIP_SIZE'],
+                )
+            return accept_member(filename)
 
-    if not valid_files:
-        flash('No valid markdown (.md) files found', 'error')
-        return redirect(url_for('index'))
+        def on_file(upload):
+            if isinstance(upload, ZipUpload):
+                upload.close()
+                return
 
-    # Read markdown content from files
-    markdown_contents = []
-    for file in valid_files:
-        filename = secure_filename(file.filename)
-        content = file.read().decode('utf-8')
-        markdown_contents.append({
-            'filename': filename,
-            'content': content
-        })
+            if isinstance(upload, ResourceUpload):
+                name = secure_path(upload.filename)
+                resources[name] = spool.store(upload.close())
+                resource_hashes.append((name, upload.hash))
+                return
 
-    # Sort files alphabetically by filename for consistent ordering
-    markdown_contents.sort(key=lambda x: x['filename'])
+            # Only decoded, hashed and lexed here; rendering waits until the
+            # ETag and output cache have been checked
+            md_file = {
+                'filename': secure_path(upload.filename),
+                'hash': upload.hash,
+                'blocks': upload.close(),
+            }
+            if upload.degraded:
+                md_file['degraded'] = True
+            stats.add_time('decode', upload.decode_seconds)
+            stats.add_time('parse', upload.lex_seconds - upload.inline_seconds)
+            stats.add_time('inline', upload.inline_seconds)
+            stats.count('input_bytes', upload.size)
+            markdown_contents.append(md_file)
 
-    # Convert to Word document
-    converter = MarkdownToWordConverter()
+        # Markdown is decoded and parsed straight off the request stream,
+        # within Flask's MAX_FORM_PARTS and MAX_FORM_MEMORY_SIZE (per field)
+        receive_uploads(
+            request.stream,
+            boundary,
+            accept_file,
+            on_file,
+            max_parts=request.max_form_parts,
+            fields=fields,
+            max_field_size=request.max_form_memory_size,
+        )
 
-    # Create a temporary file for the output
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.docx') as tmp_file:
-        output_path = tmp_file.name
+        if not selected:
+            flash('No files selected', 'error')
+            return redirect(url_for('index'))
 
-    try:
-        converter.convert(markdown_contents, output_path)
-
-        # Send the file to the user
-        return send_file(
-            output_path,
-            as_attachment=True,
-            download_name='combined_document.docx',
-            mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-        )
+        if not markdown_contents:
+            flash('No valid markdown (.md) files found', 'error')
+            return redirect(url_for('index'))
+
+        formats = requested_formats(fields)
+        unknown = [name for name in formats if name not in OUTPUT_FORMATS]
+        if unknown:
+            flash(f'Unknown output format: {", ".join(unknown)}', 'error')
+            return redirect(url_for('index'))
+        extension = download_extension(formats)
+
+        # Sort files alphabetically by filename for consistent ordering
+        markdown_contents.sort(key=lambda x: x['filename'])
+
+        # Identical uploads produce identical documents
+        etag = output_key(markdown_contents, resource_hashes, formats)
+        if etag in request.if_none_match:
+            conversion_metrics.cache_hit('etag')
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return add_timing_headers(response, stats)
+
+        if output_cache is not None:
+            cached_path = output_cache.get_path(etag)
+            if cached_path is not None:
+                conversion_metrics.cache_hit('output')
+                return add_timing_headers(send_output(cached_path, etag, extension), stats)
+
+        # What the upload left of the budget; a background job's thread starts
+        # its own clock
+        cpu_budget = None if deadline is None else deadline - time.thread_time()
+
+        # Large uploads can be converted in the background and polled for
+        async_flag = fields.get('async') or request.args.get('async', '')
+        if async_flag.lower() in ('1', 'true', 'yes'):
+            job = job_queue.submit(
+                partial(
+                    run_job, stats, markdown_contents, etag, resources, formats, cpu_budget, spool
+                ),
+                etag=etag,
+                extension=extension,
+            )
+            job_owns_spool = True
+            status = job.to_dict()
+            status['status_url'] = url_for('job_status', job_id=job.id)
+            status['download_url'] = url_for('job_download', job_id=job.id)
+            return status, 202, {'Location': status['status_url']}
+
+        # Convert to the requested formats. The output is built in memory,
+        # spilling to disk only for large documents; send_file closes (and
+        # thereby removes) it once the response is sent.
+        output = tempfile.SpooledTemporaryFile(max_size=app.config['SPOOL_MAX_BYTES'])
+
+        try:
+            build_document(stats, markdown_contents, output, etag, resources, formats, cpu_budget)
+        except Exception:
+            output.close()
+            raise
+
+        size = output.seek(0, os.SEEK_END)
+        output.seek(0)
+        response = send_output(output, etag, extension)
+        response.content_length = size
+        return add_timing_headers(response, stats)
     finally:
-        # Clean up the temporary file after sending
-        if os.path.exists(output_path):
-            os.unlink(output_path)
+        if not job_owns_spool:
+            spool.close()
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report the status of an asynchronous conversion job."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+
+    status = job.to_dict()
+    if job.status == DONE:
+        status['download_url'] = url_for('job_download', job_id=job.id)
+    return status, 200
+
+
+@app.route('/jobs/<job_id>/download', methods=['GET'])
+def job_download(job_id):
+    """Download the result of a finished conversion job."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+    if job.status != DONE:
+        return job.to_dict(), 409
+
+    return send_output(job.output_path, job.etag, job.extension)
 
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint."""
-    return {'status': 'healthy'}, 200
+    return {
+        'status': 'healthy',
+        'converter_loaded': _converter_module is not None,
+        'startup': startup_timings,
+    }, 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Conversion metrics of this process in Prometheus text format."""
+    return app.response_class(
+        conversion_metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
+if app.config['PRELOAD_CONVERTER']:
+    load_converter()
+
+startup_timings['app_import_s'] = time.perf_counter() - _import_started
+app.logger.debug('App imported in %.3fs', startup_timings['app_import_s'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,569 @@
+"""
+Benchmarks for the markdown to Word conversion pipeline.
+
+Generates synthetic markdown corpora and times the three stages of
+MarkdownToWordConverter separately:
+
+- parse: block lexing and inline scanning (parse_markdown)
+- build: creating the python-docx element tree from the parsed blocks
+- save: serializing and zipping the package (Document.save)
+
+Each scenario runs in a fresh process so its peak RSS can be reported.
+
+--check-linear instead parses pathological inputs (unmatched delimiters,
+deep emphasis runs, endless pipes and fences) at two sizes and exits with
+status 1 if any of them grows faster than linearly.
+
+--check-threads N converts a set of corpora on N threads sharing one
+ConverterEngine, as a threaded web server does, and exits with status 1 if
+any output differs from the same corpus converted on its own.
+
+--check-image-ids converts files with images in every section on the
+process pool, through the fragment cache and by incremental rebuilds, and
+exits with status 1 if any package repeats a picture id.
+
+--check-cpu-budget uploads and converts many inline-heavy files sharing one
+CPU budget, as the web app does for a request, and exits with status 1 if
+more of them are rendered in full than the budget leaves room for.
+
+Usage:
+    python benchmarks/bench_converter.py --output results.json
+    python benchmarks/bench_converter.py --scenario inline_heavy --scale 0.1
+    python benchmarks/bench_converter.py --compare baseline.json
+    python benchmarks/bench_converter.py --check-linear
+    python benchmarks/bench_converter.py --check-threads 8
+    python benchmarks/bench_converter.py --check-image-ids
+    python benchmarks/bench_converter.py --check-cpu-budget
+"""
+
+import argparse
+import gc
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversion_cache import DiskCache  # noqa: E402
+from converter import FORMAT_VERSION, ConverterEngine, MarkdownToWordConverter  # noqa: E402
+from ingest import MarkdownUpload  # noqa: E402
+from markdown_parser import parse_markdown  # noqa: E402
+
+
+WORDS = (
+    'robot sensor actuator servo controller firmware payload gripper lidar '
+    'battery torque encoder chassis module interface protocol telemetry '
+    'calibration kinematics trajectory'
+).split()
+
+MB = 1024 * 1024
+
+
+def _sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def _section(rng, paragraphs=4):
+    lines = [f'## {_sentence(rng, 4)[:-1]}', '']
+    for _ in range(paragraphs):
+        lines.append(' '.join(_sentence(rng) for _ in range(4)))
+        lines.append('')
+    lines.append('- ' + _sentence(rng, 6))
+    lines.append('- ' + _sentence(rng, 6))
+    lines.append('')
+    lines.append('> ' + _sentence(rng))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def many_small(rng, scale):
+    """Many small files of mixed content."""
+    count = max(1, int(400 * scale))
+    return [
+        {'filename': f'doc_{i:04d}.md', 'content': f'# Document {i}\n\n' + _section(rng)}
+        for i in range(count)
+    ]
+
+
+def one_huge(rng, scale):
+    """A single large file of mixed content."""
+    sections = max(1, int(2000 * scale))
+    content = '# Manual\n\n' + '\n'.join(_section(rng) for _ in range(sections))
+    return [{'filename': 'manual.md', 'content': content}]
+
+
+def list_heavy(rng, scale):
+    """Long bullet and numbered lists."""
+    lines = []
+    for block in range(max(1, int(400 * scale))):
+        for i in range(25):
+            marker = f'{i + 1}.' if block % 2 else '-'
+            lines.append(f'{marker} {_sentence(rng, 8)} *{rng.choice(WORDS)}*')
+        lines.append('')
+    return [{'filename': 'lists.md', 'content': '\n'.join(lines)}]
+
+
+def code_heavy(rng, scale):
+    """Many fenced code blocks between short paragraphs."""
+    lines = []
+    for block in range(max(1, int(1500 * scale))):
+        lines.append(_sentence(rng))
+        lines.append('')
+        lines.append('```python')
+        for i in range(15):
+            lines.append(f'    {rng.choice(WORDS)}_{i} = {rng.choice(WORDS)}({block}, {i})')
+        lines.append('```')
+        lines.append('')
+    return [{'filename': 'code.md', 'content': '\n'.join(lines)}]
+
+
+def inline_heavy(rng, scale):
+    """Paragraphs dense with emphasis, code spans and links."""
+    styles = ['*{}*', '**{}**', '***{}***', '_{}_', '__{}__', '`{}`', '[{}](http://example.com)']
+    paragraphs = []
+    for _ in range(max(1, int(3000 * scale))):
+        words = [
+            rng.choice(styles).format(word) if rng.random() < 0.4 else word
+            for word in (rng.choice(WORDS) for _ in range(40))
+        ]
+        paragraphs.append(' '.join(words))
+    return [{'filename': 'inline.md', 'content': '\n\n'.join(paragraphs)}]
+
+
+def table_heavy(rng, scale):
+    """A few very large pipe tables."""
+    lines = []
+    for table in range(max(1, int(4 * scale))):
+        lines.append(_sentence(rng))
+        lines.append('')
+        lines.append('| id | name | value | notes |')
+        lines.append('|---:|:-----|:-----:|-------|')
+        for i in range(5000):
+            lines.append(f'| {i} | **{rng.choice(WORDS)}** | `{rng.choice(WORDS)}` | {_sentence(rng, 6)} |')
+        lines.append('')
+    return [{'filename': 'tables.md', 'content': '\n'.join(lines)}]
+
+
+def adversarial(rng, scale):
+    """Log-dump-like lines full of unmatched emphasis, backticks and brackets."""
+    tokens = ['*', '**', '_', '__', '`', '``', '[', '](', '![', '|', 'a*b', '_x_y', 'f(*args)']
+    lines = []
+    for _ in range(max(1, int(20000 * scale))):
+        lines.append(' '.join(rng.choice(tokens) + rng.choice(WORDS) for _ in range(12)))
+    return [{'filename': 'adversarial.md', 'content': '\n'.join(lines)}]
+
+
+SCENARIOS = {
+    'many_small': many_small,
+    'one_huge': one_huge,
+    'list_heavy': list_heavy,
+    'code_heavy': code_heavy,
+    'inline_heavy': inline_heavy,
+    'table_heavy': table_heavy,
+    'adversarial': adversarial,
+}
+
+# Inputs that make naive markdown parsers backtrack or rescan, by the number
+# of repetitions n
+PATHOLOGICAL = {
+    'open_stars': lambda n: 'a*' * n,
+    'mixed_emphasis': lambda n: '*_a' * n,
+    'unclosed_bold': lambda n: '**a ' * n,
+    'emphasis_run': lambda n: '*' * n + 'a' + '*' * n,
+    'alternating': lambda n: '*a_' * n + '_a*' * n,
+    'intraword': lambda n: '_a_b' * n,
+    'emphasis_stairs': lambda n: ''.join('*' * (i % 7 + 1) + 'a' for i in range(n)),
+    'backticks': lambda n: '`a' * n,
+    'backtick_runs': lambda n: '``a`' * n,
+    'brackets': lambda n: '[' * n,
+    'open_links': lambda n: '[a](' * n,
+    'open_images': lambda n: '![a](' * n,
+    'hashes': lambda n: '#' * n + 'x',
+    'table_pipes': lambda n: 'a|b\n' + '|-' * n + '\n' + '|a' * n,
+    'fences': lambda n: '```\n' * n,
+    'emphasis_bullets': lambda n: '\n'.join(['- *a'] * n),
+}
+
+# Inputs are parsed at this many times the base size too
+SIZE_FACTOR = 8
+
+# How much longer parsing SIZE_FACTOR times the input may take before it
+# counts as superlinear; quadratic growth would be 64x
+LINEAR_TOLERANCE = 12.0
+
+
+def _peak_rss_mb():
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / MB if sys.platform == 'darwin' else peak / 1024
+
+
+def run_scenario(name, scale, repeat, seed):
+    """Run one scenario and return its timings (best of `repeat` runs)."""
+    markdown_files = SCENARIOS[name](random.Random(seed), scale)
+    input_bytes = sum(len(f['content'].encode('utf-8')) for f in markdown_files)
+
+    best = None
+    for _ in range(repeat):
+        converter = MarkdownToWordConverter()
+
+        start = time.perf_counter()
+        parsed = [parse_markdown(f['content']) for f in markdown_files]
+        parse_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        converter._new_document()
+        for i, (md_file, blocks) in enumerate(zip(markdown_files, parsed)):
+            if i > 0:
+                converter.document.add_page_break()
+            converter._add_section_header(md_file['filename'])
+            converter._render_blocks(blocks)
+        build_s = time.perf_counter() - start
+
+        output = io.BytesIO()
+        start = time.perf_counter()
+        converter.document.save(output)
+        save_s = time.perf_counter() - start
+
+        timings = {'parse_s': parse_s, 'build_s': build_s, 'save_s': save_s}
+        timings['total_s'] = parse_s + build_s + save_s
+        if best is None or timings['total_s'] < best['total_s']:
+            best = timings
+            best['output_bytes'] = output.tell()
+
+    input_mb = input_bytes / MB
+    result = {
+        'scenario': name,
+        'files': len(markdown_files),
+        'input_bytes': input_bytes,
+    }
+    result.update(best)
+    result['throughput_mb_s'] = {
+        stage: input_mb / best[f'{stage}_s'] if best[f'{stage}_s'] else None
+        for stage in ('parse', 'build', 'save', 'total')
+    }
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+
+def _run_in_subprocess(name, scale, repeat, seed):
+    """Run a scenario in a fresh interpreter so peak RSS is per scenario."""
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(run_scenario, (name, scale, repeat, seed))
+
+
+def check_linear(size, repeat):
+    """
+    Parse each pathological input at `size` and SIZE_FACTOR x `size` repetitions.
+
+    Returns:
+        Names of the inputs whose parse time grew more than LINEAR_TOLERANCE
+    """
+    def best_time(text):
+        # Timed with the garbage collector off, as timeit does: when its
+        # passes happen depends on what ran before, not on the input size
+        best = None
+        for _ in range(repeat):
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                parse_markdown(text)
+                elapsed = time.perf_counter() - start
+            finally:
+                gc.enable()
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def growth(make):
+        small = best_time(make(size))
+        large = best_time(make(size * SIZE_FACTOR))
+        # Sub-millisecond timings are too noisy to compare
+        return small, large, large / max(small, 1e-3)
+
+    failed = []
+    print(f"{'input':<18}{'small s':>10}{'large s':>10}{'ratio':>8}")
+    for name, make in PATHOLOGICAL.items():
+        small, large, ratio = growth(make)
+        if ratio > LINEAR_TOLERANCE:
+            # Timed again before failing it: a slow scan is slow every time
+            small, large, ratio = growth(make)
+        print(f'{name:<18}{small:>10.4f}{large:>10.4f}{ratio:>8.1f}')
+        if ratio > LINEAR_TOLERANCE:
+            failed.append(name)
+    return failed
+
+
+def _package_parts(data):
+    """Every part of a .docx package by name; reading them checks their CRCs."""
+    with zipfile.ZipFile(io.BytesIO(data)) as package:
+        return {name: package.read(name) for name in package.namelist()}
+
+
+def check_threads(threads, scale, seed):
+    """
+    Convert corpora on `threads` threads sharing one ConverterEngine, with
+    streaming output, and compare each package with a serial conversion.
+
+    Returns:
+        Number of outputs that were unreadable or differed
+    """
+    engine = ConverterEngine()
+    corpora = [
+        SCENARIOS[name](random.Random(seed + i), scale)
+        for i in range(threads)
+        for name in ('many_small', 'inline_heavy', 'table_heavy')
+    ]
+
+    def convert(markdown_files):
+        output = io.BytesIO()
+        engine.converter().convert(markdown_files, output, streaming=True)
+        return output.getvalue()
+
+    expected = [_package_parts(convert(files)) for files in corpora]
+
+    jobs = list(range(len(corpora))) * 2
+    with ThreadPoolExecutor(threads) as pool:
+        outputs = list(pool.map(lambda i: convert(corpora[i]), jobs))
+
+    failed = 0
+    for i, data in zip(jobs, outputs):
+        try:
+            parts = _package_parts(data)
+        except (zipfile.BadZipFile, zlib.error, OSError, EOFError) as exc:
+            print(f'corpus {i}: unreadable package: {exc}')
+            failed += 1
+            continue
+        if parts != expected[i]:
+            print(f'corpus {i}: output differs from the serial conversion')
+            failed += 1
+    print(f'{len(jobs)} conversions on {threads} threads, {failed} bad')
+    return failed
+
+
+def _png(width, height):
+    """A solid red RGB PNG image."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = (b'\0' + b'\xff\0\0' * width) * height
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows))
+            + chunk(b'IEND', b''))
+
+
+def check_image_ids(workers):
+    """
+    Convert files with two images each on a process pool of `workers`,
+    through the fragment cache and by incremental rebuilds, and check that
+    no package repeats a picture (wp:docPr) id.
+
+    Returns:
+        Number of packages with missing or repeated ids
+    """
+    resources = {'a.png': _png(4, 3), 'b.png': _png(3, 4)}
+    markdown_files = [
+        {'filename': f'section{i}.md', 'content': f'# Section {i}\n\n![a](a.png) and ![b](b.png)\n'}
+        for i in range(workers + 1)
+    ]
+    pictures = 2 * len(markdown_files)
+
+    changed = markdown_files[:-1] + [dict(markdown_files[-1], content='Changed ![b](b.png) ![a](a.png)\n')]
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as directory:
+        cached = ConverterEngine(cache=DiskCache(os.path.join(directory, 'cache'), 64 * MB))
+        # Fragments cached by conversions of one file each
+        for md_file in markdown_files:
+            cached.converter().convert([md_file], io.BytesIO(), streaming=True, resources=resources)
+        path = os.path.join(directory, 'incremental.docx')
+        runs = [
+            ('one document', ConverterEngine(), markdown_files, {}),
+            ('process pool', ConverterEngine(), markdown_files, {'workers': workers}),
+            ('cache hits', cached, markdown_files, {'streaming': True}),
+            ('first build', ConverterEngine(), markdown_files, {'incremental': True}),
+            # Only the changed last section is rendered again
+            ('rebuild', ConverterEngine(), changed, {'incremental': True}),
+        ]
+        for label, engine, files, options in runs:
+            output = path if options.get('incremental') else io.BytesIO()
+            engine.converter().convert(files, output, resources=resources, **options)
+            if isinstance(output, str):
+                with open(output, 'rb') as f:
+                    data = f.read()
+            else:
+                data = output.getvalue()
+            ids = re.findall(rb'<wp:docPr id="(\d+)"', _package_parts(data)['word/document.xml'])
+            if len(ids) != pictures or len(set(ids)) != len(ids):
+                print(f'{label}: {len(set(ids))} distinct picture ids for {pictures} pictures')
+                failed += 1
+    print(f'{len(runs)} packages with {pictures} pictures each, {failed} bad')
+    return failed
+
+
+def check_cpu_budget(files, budget, workers):
+    """
+    Upload and convert `files` inline-heavy markdown files that share a CPU
+    budget of `budget` seconds, as the web app does, in-process and on a
+    process pool of `workers`, and check that the budget bounds the work.
+
+    Returns:
+        Number of runs that rendered more files in full than the budget
+        allows, or used more CPU time in-process
+    """
+    data = (('*a* **b** `c` [l](u) _d_ ~~e~~ ' * 8 + '\n') * 500).encode()
+    engine = ConverterEngine(cpu_budget=20)
+
+    def run(count, deadline, workers=0, budget_upload=True):
+        """
+        Upload and convert count files; return their stats, the thread CPU
+        time taken and the part of it spent converting.
+        """
+        started = time.thread_time()
+        markdown_files = []
+        for i in range(count):
+            upload = MarkdownUpload(f'file{i}.md', engine.cpu_budget, deadline if budget_upload else None)
+            upload.write(data)
+            md_file = {'filename': upload.filename, 'blocks': upload.close()}
+            if upload.degraded:
+                md_file['degraded'] = True
+            markdown_files.append(md_file)
+        converter = engine.converter()
+        uploaded = time.thread_time()
+        if not budget_upload:
+            deadline += uploaded - started
+        converter.convert(
+            markdown_files, io.BytesIO(), streaming=True, workers=workers,
+            total_cpu_budget=None if deadline is None else deadline - uploaded,
+        )
+        return converter.stats, time.thread_time() - started, time.thread_time() - uploaded
+
+    # What a file costs in full (and to convert alone), and cut short to
+    # plain text from the start
+    full, build = min(run(1, None)[1:] for _ in range(2))
+    plain = run(1, time.thread_time())[1]
+
+    failed = 0
+    runs = [
+        ('in-process', 0, True),
+        ('process pool', workers, True),
+        # Only the conversion is budgeted, so the pool's share is what counts
+        ('pool, unbudgeted upload', workers, False),
+    ]
+    for label, pool_workers, budget_upload in runs:
+        stats, cpu, _ = run(files, time.thread_time() + budget, pool_workers, budget_upload)
+        rendered = files - stats.counts['degraded_sections']
+        # Files started before the budget ran out, plus, for each worker,
+        # one running, one queued and one finished but not yet collected in
+        # order when it does
+        allowed = int(budget / build) + 2 + 3 * pool_workers
+        limit = budget + files * plain * 2 + 0.5 if not pool_workers else None
+        print(f'{label}: {rendered} of {files} files in full (at most {allowed}), '
+              f'{cpu:.2f}s CPU in this thread' + (f' (at most {limit:.2f}s)' if limit else ''))
+        if rendered > allowed or (limit and cpu > limit):
+            failed += 1
+    print(f'one file: {full:.2f}s in full, {plain:.3f}s as plain text; '
+          f'{files} files unbudgeted: ~{files * full:.0f}s')
+    return failed
+
+
+def _print_results(results, baseline=None):
+    previous = {}
+    if baseline:
+        previous = {r['scenario']: r for r in baseline['results']}
+
+    header = f"{'scenario':<14}{'MB':>8}{'parse':>9}{'build':>9}{'save':>9}{'total':>9}{'MB/s':>9}{'RSS MB':>9}"
+    if previous:
+        header += f"{'vs base':>10}"
+    print(header)
+    for r in results:
+        line = (
+            f"{r['scenario']:<14}{r['input_bytes'] / MB:>8.2f}"
+            f"{r['parse_s']:>9.3f}{r['build_s']:>9.3f}{r['save_s']:>9.3f}{r['total_s']:>9.3f}"
+            f"{r['throughput_mb_s']['total']:>9.2f}{r['peak_rss_mb']:>9.1f}"
+        )
+        base = previous.get(r['scenario'])
+        if base:
+            line += f"{base['total_s'] / r['total_s']:>9.2f}x"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run (repeatable, default: all)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplier for the corpus size (default: 1.0)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per scenario, the fastest is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=1234, help='Corpus random seed')
+    parser.add_argument('--output', help='Write results as JSON to this file')
+    parser.add_argument('--compare', help='Baseline JSON file to compare against')
+    parser.add_argument('--check-linear', action='store_true',
+                        help='Check that pathological inputs parse in linear time and exit')
+    parser.add_argument('--check-threads', type=int, metavar='THREADS',
+                        help='Check that concurrent conversions on one engine match serial ones and exit')
+    parser.add_argument('--check-image-ids', action='store_true',
+                        help='Check that picture ids are unique across separately rendered sections and exit')
+    parser.add_argument('--check-cpu-budget', action='store_true',
+                        help='Check that a shared CPU budget bounds the conversion of many files and exit')
+    args = parser.parse_args(argv)
+
+    if args.check_cpu_budget:
+        return 1 if check_cpu_budget(30, 1.0, 2) else 0
+
+    if args.check_image_ids:
+        return 1 if check_image_ids(3) else 0
+
+    if args.check_threads:
+        return 1 if check_threads(args.check_threads, args.scale * 0.02, args.seed) else 0
+
+    if args.check_linear:
+        failed = check_linear(max(1, int(20000 * args.scale)), args.repeat)
+        if failed:
+            print('Superlinear parse time: ' + ', '.join(failed), file=sys.stderr)
+            return 1
+        return 0
+
+    results = [
+        _run_in_subprocess(name, args.scale, args.repeat, args.seed)
+        for name in (args.scenario or list(SCENARIOS))
+    ]
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'format_version': FORMAT_VERSION,
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'results': results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    _print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,6 +23,11 @@ from models import (
     db, User, Listing, ListingImage, Message, Review,
     SearchAlert, Article, Report, SiteSettings
 )
+from facets import facet_counts
+from pagination import paginate_keyset
+from search_index import (
+    apply_text_search, create_search_index, ensure_search_index, rebuild_search_index
+)
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -37,6 +42,12 @@ login_manager.login_message_category = 'info'
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Servers started without init-db (flask run, gunicorn) still get the search
+# index; once it exists this does nothing
+with app.app_context():
+    with db.engine.begin() as connection:
+        ensure_search_index(connection)
+
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -96,21 +107,16 @@ def home():
         status='active'
     ).order_by(Listing.created_at.desc()).limit(12).all()
 
-    # Get category counts
-    category_counts = db.session.query(
-        Listing.category, db.func.count(Listing.id)
-    ).filter_by(status='active').group_by(Listing.category).all()
-
-    # Get popular brands
-    popular_brands = db.session.query(
-        Listing.brand, db.func.count(Listing.id).label('count')
-    ).filter(Listing.status == 'active', Listing.brand.isnot(None)
-    ).group_by(Listing.brand).order_by(db.desc('count')).limit(10).all()
+    # Get category counts and popular brands
+    facets = facet_counts({})['facets']
+    popular_brands = sorted(
+        facets['brand'].items(), key=lambda item: item[1], reverse=True
+    )[:10]
 
     return render_template('home.html',
         featured=featured,
         latest=latest,
-        category_counts=dict(category_counts),
+        category_counts=facets['category'],
         popular_brands=popular_brands
     )
 
@@ -266,24 +272,10 @@ def forgot_password():
 @app.route('/search')
 def search():
     """Search listings with filters"""
-    page = request.args.get('page', 1, type=int)
 
     # Base query
     query = Listing.query.filter_by(status='active')
 
-    # Text search
-    q = request.args.get('q', '').strip()
-    if q:
-        search_term = f"%{q}%"
-        query = query.filter(
-            db.or_(
-                Listing.title.ilike(search_term),
-                Listing.description.ilike(search_term),
-                Listing.brand.ilike(search_term),
-                Listing.model.ilike(search_term)
-            )
-        )
-
     # Category filter
     category = request.args.get('category')
     if category:
@@ -329,26 +321,40 @@ def search():
     if seller_type:
         query = query.join(User).filter(User.seller_type == seller_type)
 
-    # Sorting
-    sort = request.args.get('sort', 'newest')
-    if sort == 'price_low':
-        query = query.order_by(Listing.price.asc())
+    # Text search through the full-text index, after the filter_by() calls
+    q = request.args.get('q', '').strip()
+    relevance = None
+    if q:
+        query, relevance = apply_text_search(query, q)
+
+    # Sorting; keyword searches default to best match first. Every order
+    # ends with the id so that pages can continue from the last listing shown
+    sort = request.args.get('sort', 'relevance' if relevance is not None else 'newest')
+    if sort == 'relevance' and relevance is not None:
+        order = [relevance, Listing.created_at.desc()]
+    elif sort == 'price_low':
+        order = [Listing.price.asc()]
     elif sort == 'price_high':
-        query = query.order_by(Listing.price.desc())
+        order = [Listing.price.desc()]
     elif sort == 'oldest':
-        query = query.order_by(Listing.created_at.asc())
+        order = [Listing.created_at.asc()]
     else:  # newest
-        query = query.order_by(Listing.created_at.desc())
+        order = [Listing.created_at.desc()]
 
     # Featured first option
     if request.args.get('featured_first'):
-        query = query.order_by(Listing.is_featured.desc())
-
-    # Pagination
-    listings = query.paginate(
-        page=page,
+        order.append(Listing.is_featured.desc())
+    order.append(Listing.id.asc() if sort in ('oldest', 'price_low') else Listing.id.desc())
+
+    # Pagination; the cursor is only valid for the filters it was made with
+    filters = {key: value for key, value in request.args.items() if key not in ('cursor', 'page')}
+    listings = paginate_keyset(
+        query,
+        order,
+        cursor=request.args.get('cursor'),
         per_page=app.config['LISTINGS_PER_PAGE'],
-        error_out=False
+        scope=filters,
+        count=True
     )
 
     # Get filter options for sidebar
@@ -358,7 +364,7 @@ def search():
     return render_template('search/results.html',
         listings=listings,
         query=q,
-        filters=request.args,
+        filters=filters,
         states=states
     )
 
@@ -481,24 +487,13 @@ def toggle_save_listing(id):
 @app.route('/api/listings/count')
 def listings_count():
     """Get count of listings matching filters"""
-    query = Listing.query.filter_by(status='active')
-
-    category = request.args.get('category')
-    if category:
-        query = query.filter_by(category=category)
+    return jsonify({'count': facet_counts(request.args)['total']})
 
-    brand = request.args.get('brand')
-    if brand:
-        query = query.filter_by(brand=brand)
-
-    min_price = request.args.get('min_price', type=float)
-    max_price = request.args.get('max_price', type=float)
-    if min_price:
-        query = query.filter(Listing.price >= min_price)
-    if max_price:
-        query = query.filter(Listing.price <= max_price)
 
-    return jsonify({'count': query.count()})
+@app.route('/api/listings/facets')
+def listings_facets():
+    """Get listing counts for each value of the search filters"""
+    return jsonify(facet_counts(request.args))
 
 
 # =============================================================================
@@ -1140,9 +1135,11 @@ def admin_dashboard():
 @admin_required
 def admin_users():
     """Admin user management"""
-    page = request.args.get('page', 1, type=int)
-    users = User.query.order_by(User.created_at.desc()).paginate(
-        page=page, per_page=50
+    users = paginate_keyset(
+        User.query,
+        [User.created_at.desc(), User.id.desc()],
+        cursor=request.args.get('cursor'),
+        per_page=50
     )
     return render_template('admin/users.html', users=users)
 
@@ -1152,15 +1149,18 @@ def admin_users():
 @admin_required
 def admin_listings():
     """Admin listing management"""
-    page = request.args.get('page', 1, type=int)
     status = request.args.get('status', 'all')
 
     query = Listing.query
     if status != 'all':
         query = query.filter_by(status=status)
 
-    listings = query.order_by(Listing.created_at.desc()).paginate(
-        page=page, per_page=50
+    listings = paginate_keyset(
+        query,
+        [Listing.created_at.desc(), Listing.id.desc()],
+        cursor=request.args.get('cursor'),
+        per_page=50,
+        scope=status
     )
     return render_template('admin/listings.html', listings=listings, current_status=status)
 
@@ -1343,9 +1343,22 @@ def uploaded_file(filename):
 def init_db():
     """Initialize the database"""
     db.create_all()
+    with db.engine.begin() as connection:
+        # create_all() leaves out new indexes of tables that already exist
+        for index in Listing.__table__.indexes:
+            index.create(connection, checkfirst=True)
+        create_search_index(connection)
     print('Database initialized!')
 
 
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuild the listing search index"""
+    with db.engine.begin() as connection:
+        rebuild_search_index(connection)
+    print('Search index rebuilt!')
+
+
 @app.cli.command('create-admin')
 def create_admin():
     """Create an admin user"""
@@ -1375,4 +1388,6 @@ def seed_demo():
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        with db.engine.begin() as connection:
+            create_search_index(connection)
     app.run(debug=True, port=5000)
@@ -24,6 +24,9 @@ class Config:
     LISTINGS_PER_PAGE = 20
     MESSAGES_PER_PAGE = 50
 
+    # Seconds that search filter counts are cached for
+    FACET_CACHE_SECONDS = int(os.environ.get('FACET_CACHE_SECONDS', 30))
+
     # Email settings (configure for production)
     MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
     MAIL_PORT = int(os.environ.get('MAIL_PORT', 587))
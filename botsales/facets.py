@@ -0,0 +1,124 @@
+"""
+BotSales.com Search Facets
+Listing counts for every value of the search sidebar filters.
+
+All dimensions are counted with one GROUP BY over the facet columns; each
+dimension's counts then apply every selected filter except its own, so the
+sidebar shows how many listings picking another value would give. Results
+are cached briefly per filter set.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from models import db, Listing, User
+from search_index import apply_text_search
+
+
+# Filter dimensions counted, and the columns they filter on
+FACETS = ('category', 'brand', 'condition', 'state', 'seller_type')
+FACET_COLUMNS = {
+    'category': Listing.category,
+    'brand': Listing.brand,
+    'condition': Listing.condition,
+    'state': Listing.state,
+    'seller_type': User.seller_type,
+}
+
+# Numeric filters, applied like search() does
+RANGE_FILTERS = {
+    'min_price': float,
+    'max_price': float,
+    'min_year': int,
+    'max_year': int,
+}
+
+# Number of filter sets whose counts are kept
+CACHE_SIZE = 256
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def parse_filters(args):
+    """The search filters set in args, as a dict of the ones that affect counts"""
+    filters = {}
+    for name in FACETS + ('q', 'postcode'):
+        value = (args.get(name) or '').strip()
+        if value:
+            filters[name] = value
+    for name, convert in RANGE_FILTERS.items():
+        try:
+            value = convert(args.get(name))
+        except (TypeError, ValueError):
+            continue
+        if value:
+            filters[name] = value
+    return filters
+
+
+def _count_facets(filters):
+    columns = [FACET_COLUMNS[name] for name in FACETS]
+    query = (
+        db.session.query(*columns, db.func.count(Listing.id))
+        .select_from(Listing)
+        .join(User, Listing.seller_id == User.id)
+        .filter(Listing.status == 'active')
+    )
+
+    if 'min_price' in filters:
+        query = query.filter(Listing.price >= filters['min_price'])
+    if 'max_price' in filters:
+        query = query.filter(Listing.price <= filters['max_price'])
+    if 'min_year' in filters:
+        query = query.filter(Listing.year >= filters['min_year'])
+    if 'max_year' in filters:
+        query = query.filter(Listing.year <= filters['max_year'])
+    if 'postcode' in filters:
+        query = query.filter(Listing.postcode.like(f"{filters['postcode']}%"))
+    if 'q' in filters:
+        query, _ = apply_text_search(query, filters['q'])
+
+    selected = {name: filters[name] for name in FACETS if name in filters}
+    counts = {name: {} for name in FACETS}
+    total = 0
+    for row in query.group_by(*columns).all():
+        values = dict(zip(FACETS, row))
+        number = row[-1]
+        missed = [name for name, value in selected.items() if values[name] != value]
+        if not missed:
+            total += number
+        # A group counts towards a dimension when it matches every other filter
+        for name in FACETS:
+            if (not missed or missed == [name]) and values[name] is not None:
+                counts[name][values[name]] = counts[name].get(values[name], 0) + number
+
+    return {'total': total, 'facets': counts}
+
+
+def facet_counts(args):
+    """
+    Count active listings for every value of each facet under the filters in
+    args (request.args or a dict). Returns {'total': n, 'facets': {dimension:
+    {value: n}}}; the result is shared between callers and must not be changed.
+    """
+    filters = parse_filters(args)
+    key = tuple(sorted(filters.items()))
+    now = time.monotonic()
+
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry and entry[0] > now:
+            _cache.move_to_end(key)
+            return entry[1]
+
+    result = _count_facets(filters)
+
+    with _cache_lock:
+        _cache[key] = (now + current_app.config['FACET_CACHE_SECONDS'], result)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
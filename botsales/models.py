@@ -91,6 +91,12 @@ class User(UserMixin, db.Model):
 class Listing(db.Model):
     """Robot listing model"""
     __tablename__ = 'listings'
+    __table_args__ = (
+        # Active listings in search sort order, down to the id that
+        # paginated searches seek past
+        db.Index('ix_listings_status_created_at', 'status', 'created_at', 'id'),
+        db.Index('ix_listings_status_price', 'status', 'price', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     seller_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
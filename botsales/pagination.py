@@ -0,0 +1,182 @@
+"""
+BotSales.com Keyset Pagination
+Cursor-based paging through long, sorted result lists.
+
+Pages are fetched by seeking past the sort key of the last row shown instead
+of with OFFSET, so a deep page costs the same as the first one. Cursors are
+signed tokens carrying that sort key, the page number and the result count
+taken on the first page, so later pages never count again.
+"""
+import json
+import math
+import zlib
+from datetime import datetime
+
+from flask import current_app
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy.sql import operators
+
+from models import db
+
+
+# Result counts stop at this many rows and are shown as "10000+"
+COUNT_LIMIT = 10000
+
+
+class KeysetPage:
+    """One page of results and the cursors of the pages either side of it"""
+
+    def __init__(self, items, page, per_page, total, total_capped,
+                 prev_cursor, next_cursor):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.total_capped = total_capped
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def pages(self):
+        """Number of pages, or None if the results were not counted"""
+        if self.total is None:
+            return None
+        return max(1, math.ceil(self.total / self.per_page))
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='keyset-cursor')
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return datetime.fromisoformat(value['datetime'])
+    return value
+
+
+def _scope_hash(scope):
+    """Short checksum tying a cursor to the filters and sort it was made for"""
+    return zlib.crc32(json.dumps(scope, sort_keys=True, default=str).encode())
+
+
+def _seek(keys, values, backwards):
+    """
+    Condition selecting the rows after the given sort key (or before it when
+    going backwards): a > x OR (a = x AND b > y) OR ..., for mixed directions
+    """
+    # Bound as typed parameters, since SQLAlchemy will not compare < True
+    values = [db.literal(value, expression.type) for (expression, _), value in zip(keys, values)]
+    clauses = []
+    for i, ((expression, descending), value) in enumerate(zip(keys, values)):
+        if descending != backwards:
+            past = expression < value
+        else:
+            past = expression > value
+        ties = [key == earlier for (key, _), earlier in zip(keys[:i], values[:i])]
+        clauses.append(db.and_(*ties, past))
+
+    # Redundant bound on the leading key, which lets an index on it seek
+    expression, descending = keys[0]
+    if descending != backwards:
+        leading = expression <= values[0]
+    else:
+        leading = expression >= values[0]
+    return db.and_(leading, db.or_(*clauses))
+
+
+def paginate_keyset(query, order, cursor=None, per_page=20, scope=None, count=False):
+    """
+    Return a KeysetPage of query ordered by order, a list of ascending or
+    descending column expressions whose last entry makes the order unique
+    (normally the primary key). Key columns must not be NULL.
+
+    cursor is a prev_cursor or next_cursor of an earlier page; a missing,
+    tampered or stale one (made for another scope) gives the first page.
+    scope is any JSON-serialisable description of the filters and sort, so a
+    cursor cannot be replayed against different results. With count=True the
+    results are counted on the first page, up to COUNT_LIMIT.
+    """
+    keys = [(clause.element, clause.modifier is operators.desc_op) for clause in order]
+    scope = _scope_hash(scope)
+
+    state = None
+    if cursor:
+        try:
+            state = _serializer().loads(cursor)
+        except BadSignature:
+            state = None
+        if state and (state.get('s') != scope or len(state.get('k', ())) != len(keys)):
+            state = None
+
+    if state:
+        page = max(1, state['p'])
+        total = state['n']
+        backwards = state['d'] == 'prev'
+        values = [_decode_value(value) for value in state['k']]
+    else:
+        page = 1
+        total = None
+        backwards = False
+        values = None
+        if count:
+            total = query.order_by(None).limit(COUNT_LIMIT + 1).count()
+    total_capped = total is not None and total > COUNT_LIMIT
+    if total_capped:
+        total = COUNT_LIMIT
+
+    # Fetch the sort key along with each row, and one row more than a page
+    # to tell whether another page follows
+    fetch = query.add_columns(*(expression for expression, _ in keys))
+    if values is not None:
+        fetch = fetch.filter(_seek(keys, values, backwards))
+    fetch = fetch.order_by(None).order_by(*(
+        expression.desc() if descending != backwards else expression.asc()
+        for expression, descending in keys
+    ))
+    rows = fetch.limit(per_page + 1).all()
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+        has_prev, has_next = more, True
+        if not more:
+            page = 1
+    else:
+        has_prev, has_next = values is not None, more
+
+    def make_cursor(row, direction, target):
+        return _serializer().dumps({
+            'k': [_encode_value(value) for value in row[1:]],
+            'p': target,
+            'n': total if not total_capped else COUNT_LIMIT + 1,
+            'd': direction,
+            's': scope,
+        })
+
+    prev_cursor = make_cursor(rows[0], 'prev', page - 1) if rows and has_prev else None
+    next_cursor = make_cursor(rows[-1], 'next', page + 1) if rows and has_next else None
+
+    return KeysetPage(
+        items=[row[0] for row in rows],
+        page=page,
+        per_page=per_page,
+        total=total,
+        total_capped=total_capped,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+    )
@@ -0,0 +1,169 @@
+"""
+BotSales.com Listing Search Index
+Full-text search over listing titles, descriptions, brands and models.
+
+SQLite uses an FTS5 table that triggers keep in sync with the listings
+table; PostgreSQL uses a GIN index over a weighted tsvector expression.
+Other databases fall back to LIKE scans.
+"""
+import re
+
+from sqlalchemy import column, event, func, inspect, literal_column, select, table, text
+
+from models import db, Listing
+
+
+# At most this many words of a query are searched for
+MAX_TERMS = 8
+
+# -----------------------------------------------------------------------------
+# SQLite (FTS5)
+# -----------------------------------------------------------------------------
+
+# External content table: only the index is stored, the text stays in
+# listings. Every listing is indexed; status is filtered on the listings side,
+# so status changes take effect without touching the index.
+SQLITE_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(
+        title, description, brand, model,
+        content='listings', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS listings_fts_insert AFTER INSERT ON listings BEGIN
+        INSERT INTO listings_fts (rowid, title, description, brand, model)
+        VALUES (new.id, new.title, new.description, new.brand, new.model);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS listings_fts_delete AFTER DELETE ON listings BEGIN
+        INSERT INTO listings_fts (listings_fts, rowid, title, description, brand, model)
+        VALUES ('delete', old.id, old.title, old.description, old.brand, old.model);
+    END
+    """,
+    # Only edits of the indexed columns reindex a listing, not view counts
+    """
+    CREATE TRIGGER IF NOT EXISTS listings_fts_update
+    AFTER UPDATE OF title, description, brand, model ON listings BEGIN
+        INSERT INTO listings_fts (listings_fts, rowid, title, description, brand, model)
+        VALUES ('delete', old.id, old.title, old.description, old.brand, old.model);
+        INSERT INTO listings_fts (rowid, title, description, brand, model)
+        VALUES (new.id, new.title, new.description, new.brand, new.model);
+    END
+    """,
+]
+
+# bm25 weights of the title, description, brand and model columns
+SQLITE_WEIGHTS = (10.0, 1.0, 5.0, 5.0)
+
+listings_fts = table('listings_fts', column('rowid'), column('listings_fts'))
+
+# -----------------------------------------------------------------------------
+# PostgreSQL (tsvector)
+# -----------------------------------------------------------------------------
+
+# Title matches rank above brand and model, which rank above description
+POSTGRES_VECTOR = (
+    "setweight(to_tsvector('english', coalesce({t}title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce({t}brand, '') || ' ' || coalesce({t}model, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce({t}description, '')), 'D')"
+)
+
+# The index stays in sync by itself; queries must use the same expression
+POSTGRES_DDL = (
+    'CREATE INDEX IF NOT EXISTS ix_listings_search ON listings USING GIN (('
+    + POSTGRES_VECTOR.format(t='') + '))'
+)
+
+
+def search_terms(q):
+    """Split a search query into lowercase words"""
+    return re.findall(r'\w+', q.lower())[:MAX_TERMS]
+
+
+def create_search_index(connection):
+    """Create the search index if it does not exist yet, indexing existing listings"""
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'listings_fts'")
+        ).first()
+        for statement in SQLITE_DDL:
+            connection.execute(text(statement))
+        if not exists:
+            connection.execute(text("INSERT INTO listings_fts (listings_fts) VALUES ('rebuild')"))
+    elif dialect == 'postgresql':
+        connection.execute(text(POSTGRES_DDL))
+
+
+def ensure_search_index(connection):
+    """
+    Create the search index of an existing listings table that lacks it, as
+    in a database set up before the index was added. A new listings table
+    gets its index when it is created.
+    """
+    if inspect(connection).has_table('listings'):
+        create_search_index(connection)
+
+
+def rebuild_search_index(connection):
+    """Rebuild the search index from the listings table"""
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        create_search_index(connection)
+        connection.execute(text("INSERT INTO listings_fts (listings_fts) VALUES ('rebuild')"))
+    elif dialect == 'postgresql':
+        create_search_index(connection)
+        connection.execute(text('REINDEX INDEX ix_listings_search'))
+
+
+@event.listens_for(Listing.__table__, 'after_create')
+def _create_with_listings(target, connection, **kw):
+    """Create the search index along with the listings table"""
+    create_search_index(connection)
+
+
+def apply_text_search(query, q):
+    """
+    Restrict a Listing query to listings matching every word of q, as
+    prefixes ('rob' finds 'robot'). Returns the query and an ordering that
+    puts the best matches first, or None if the database cannot rank them.
+    The index may be joined in, so apply this after any filter_by() calls.
+    """
+    terms = search_terms(q)
+    if not terms:
+        return query.filter(db.false()), None
+
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        match = ' '.join(f'"{term}"*' for term in terms)
+        rank = func.bm25(literal_column('listings_fts'), *SQLITE_WEIGHTS).label('rank')
+        # Materialized so the match runs once; flattened into the outer query,
+        # SQLite would rather scan listings by status and match row by row
+        matches = (
+            select(listings_fts.c.rowid, rank)
+            .where(listings_fts.c.listings_fts.op('MATCH')(match))
+            .cte('matches')
+            .prefix_with('MATERIALIZED')
+        )
+        query = query.join(matches, matches.c.rowid == Listing.id)
+        # bm25 scores are negative; lower is better
+        return query, matches.c.rank.asc()
+
+    if dialect == 'postgresql':
+        vector = literal_column(POSTGRES_VECTOR.format(t='listings.'))
+        tsquery = func.to_tsquery('english', ' & '.join(f'{term}:*' for term in terms))
+        query = query.filter(vector.op('@@')(tsquery))
+        return query, func.ts_rank(vector, tsquery).desc()
+
+    for term in terms:
+        pattern = f'%{term}%'
+        query = query.filter(db.or_(
+            Listing.title.ilike(pattern),
+            Listing.description.ilike(pattern),
+            Listing.brand.ilike(pattern),
+            Listing.model.ilike(pattern)
+        ))
+    return query, None
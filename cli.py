@@ -0,0 +1,202 @@
+"""
+Command-line batch conversion of markdown trees to Word documents.
+
+Usage:
+    python cli.py docs/ -o manual.docx
+    python cli.py 'docs/**/*.md' notes/ --per-folder --output-dir build/
+"""
+
+import argparse
+import functools
+import glob
+import hashlib
+import mmap
+import os
+import sys
+
+from conversion_cache import DiskCache
+from converter import FORMAT_VERSION, ConverterEngine, load_manifest, manifest_path
+from doc_template import get_template
+
+
+def collect_sources(inputs):
+    """
+    Expand directories and glob patterns into markdown files.
+
+    Returns:
+        Sorted list of (root, path) tuples, where root is the directory that
+        section names are made relative to
+    """
+    sources = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            root = os.path.normpath(pattern)
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    if name.lower().endswith('.md'):
+                        sources.add((root, os.path.join(dirpath, name)))
+        else:
+            for path in glob.glob(pattern, recursive=True):
+                if os.path.isfile(path) and path.lower().endswith('.md'):
+                    sources.add((os.path.dirname(path) or '.', os.path.normpath(path)))
+    return sorted(sources, key=lambda source: source[1])
+
+
+def hash_file(path):
+    """
+    Return the sha256 hex digest of a file.
+
+    The file is memory-mapped only while it is hashed: a mapping holds a
+    file descriptor of its own, so keeping one per source would run a large
+    tree into the open file limit.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256(b'').hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return hashlib.sha256(data).hexdigest()
+
+
+def read_markdown(path):
+    """Return the text of a UTF-8 markdown file."""
+    with open(path, 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+class DirectoryResources:
+    """Files next to the markdown sources, read from disk when asked for."""
+
+    def __init__(self, roots):
+        self.roots = roots
+
+    def get(self, path):
+        """Return the bytes of a file relative to the first root that has it."""
+        for root in self.roots:
+            try:
+                with open(os.path.join(root, *path.split('/')), 'rb') as f:
+                    return f.read()
+            except OSError:
+                continue
+        return None
+
+
+def build(output_path, sources, converter, workers=0, force=False):
+    """
+    Convert a list of markdown files into one document unless it is up to date.
+
+    Args:
+        output_path: Path of the .docx to write
+        sources: List of (root, path) tuples, in document order
+        converter: MarkdownToWordConverter to use
+        workers: Number of conversion processes
+        force: Rebuild even if the inputs have not changed
+
+    Returns:
+        True if the document was (re)built, False if it was up to date
+    """
+    # Files are only hashed here; each is read when it is converted
+    markdown_files = [
+        {
+            'filename': os.path.relpath(path, root).replace(os.sep, '/'),
+            'hash': hash_file(path),
+            'content': functools.partial(read_markdown, path),
+        }
+        for root, path in sources
+    ]
+
+    manifest = load_manifest(output_path)
+    if not force and manifest and os.path.exists(output_path):
+        built = [(s['filename'], s['hash']) for s in manifest.get('sources', [])]
+        current = [(f['filename'], f['hash']) for f in markdown_files]
+        # Images are only found by parsing, so documents with images are
+        # always rebuilt (reusing the sections that did not change), as are
+        # documents with sections cut short by the CPU budget (no key)
+        has_images = any(s.get('key', s['hash']) != s['hash'] for s in manifest.get('sources', []))
+        if (manifest.get('format_version') == FORMAT_VERSION
+                and manifest.get('fingerprint') == converter.fingerprint
+                and built == current and not has_images):
+            return False
+
+    # Unchanged sections are spliced in from the previous output, unless
+    # forced to start over
+    if force and os.path.exists(manifest_path(output_path)):
+        os.unlink(manifest_path(output_path))
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    resources = DirectoryResources(sorted({root for root, _ in sources}))
+    converter.convert(
+        markdown_files, output_path, workers=workers, incremental=True, resources=resources
+    )
+    return True
+
+
+def group_by_folder(sources):
+    """Group sources by the directory that contains them."""
+    folders = {}
+    for root, path in sources:
+        folders.setdefault((root, os.path.dirname(path)), []).append((root, path))
+    return folders
+
+
+def folder_output(output_dir, root, folder):
+    """Return the output path of a per-folder document."""
+    relative = os.path.relpath(folder, root)
+    if relative == os.curdir:
+        relative = os.path.basename(os.path.abspath(root))
+    return os.path.join(output_dir, relative + '.docx')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert markdown files to Word documents.')
+    parser.add_argument('inputs', nargs='+', help='Directories or glob patterns of .md files')
+    parser.add_argument('-o', '--output', default='combined_document.docx',
+                        help='Combined output document (default: combined_document.docx)')
+    parser.add_argument('--per-folder', action='store_true',
+                        help='Write one document per folder instead of one combined document')
+    parser.add_argument('--output-dir', default='.',
+                        help='Directory for per-folder documents (default: current directory)')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of conversion processes (default: CPU count)')
+    parser.add_argument('--cache-dir', help='Directory for the per-file conversion cache')
+    parser.add_argument('--cache-max-bytes', type=int, default=256 * 1024 * 1024,
+                        help='Size cap of the conversion cache (default: 256 MB)')
+    parser.add_argument('--template', help='.docx or .dotx file to take styles and page setup from')
+    parser.add_argument('--highlight-style', default='default',
+                        help='Pygments style for code blocks with a fence language (default: default)')
+    parser.add_argument('--no-highlight', action='store_true',
+                        help='Render all code blocks without syntax highlighting')
+    parser.add_argument('--cpu-budget', type=float,
+                        help='Seconds of CPU time per markdown file before the rest of it '
+                             'is rendered as plain text (default: unlimited)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Rebuild outputs even if their inputs are unchanged')
+    args = parser.parse_args(argv)
+
+    sources = collect_sources(args.inputs)
+    if not sources:
+        print('No markdown (.md) files found', file=sys.stderr)
+        return 1
+
+    cache = DiskCache(args.cache_dir, args.cache_max_bytes) if args.cache_dir else None
+    template = get_template(args.template) if args.template else None
+    highlight_style = None if args.no_highlight else args.highlight_style
+    engine = ConverterEngine(
+        cache=cache, template=template, highlight_style=highlight_style, cpu_budget=args.cpu_budget
+    )
+
+    if args.per_folder:
+        jobs = [
+            (folder_output(args.output_dir, root, folder), folder_sources)
+            for (root, folder), folder_sources in sorted(group_by_folder(sources).items())
+        ]
+    else:
+        jobs = [(args.output, sources)]
+
+    for output_path, job_sources in jobs:
+        built = build(output_path, job_sources, engine.converter(), args.workers, args.force)
+        status = 'built' if built else 'up to date'
+        print(f'{output_path}: {status} ({len(job_sources)} files)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Content-addressed on-disk cache for conversion results.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: the total is kept per process
+    fcntl = None
+
+
+def content_hash(content):
+    """Return the SHA-256 hex digest of markdown text (as UTF-8)."""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    """
+    Size-capped least-recently-used cache of byte blobs in a local directory.
+
+    Each entry is a file named after its key. Recency is tracked through the
+    file modification time, so the LRU order survives restarts and entries
+    written by other processes sharing the directory are picked up on read.
+    The total size of the entries is kept in a .total file, locked while it
+    is updated, so the cap holds for all processes together; the directory
+    is only scanned when the total goes over the cap.
+    """
+
+    def __init__(self, directory, max_bytes):
+        """
+        Args:
+            directory: Directory holding the cache entries (created if missing)
+            max_bytes: Total size above which least recently used entries
+                are evicted
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Total size of the entries, when it cannot be shared through .total
+        self._total = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._total_path = os.path.join(directory, '.total') if fcntl is not None else None
+        self._total_fd = None
+        self._total_pid = None
+        # Recount, in case entries were added or removed behind the total
+        with self._locked():
+            self._write_total(self._evict())
+
+    @staticmethod
+    def key(*parts):
+        """Build a cache key from strings or bytes."""
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            digest.update(part)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def path(self, key):
+        """Return the file path of an entry."""
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Return the cached bytes for key, or None on a miss."""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def get_path(self, key):
+        """Return the file path of a cached entry, or None on a miss."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, data):
+        """Store bytes under key, evicting old entries to stay under the cap."""
+        if len(data) > self.max_bytes:
+            return
+        self._store(key, len(data), lambda f: f.write(data))
+
+    def put_fileobj(self, key, fileobj):
+        """Store the contents of a seekable file object under key."""
+        size = fileobj.seek(0, os.SEEK_END)
+        if size > self.max_bytes:
+            return
+
+        def copy(f):
+            fileobj.seek(0)
+            shutil.copyfileobj(fileobj, f)
+        self._store(key, size, copy)
+
+    def _store(self, key, size, write):
+        """Atomically write an entry through write(fileobj) and count it."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, self.path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        with self._locked():
+            # Replacing an entry counts it twice until the next recount
+            total = self._read_total() + size
+            if total > self.max_bytes:
+                total = self._evict()
+            self._write_total(total)
+
+    @contextmanager
+    def _locked(self):
+        """Hold the lock on the total, against other threads and processes."""
+        with self._lock:
+            if self._total_path is None:
+                yield
+                return
+            if self._total_pid != os.getpid():
+                # Opened per process: forked children would share the
+                # parent's lock instead of waiting for it
+                self._total_fd = os.open(self._total_path, os.O_RDWR | os.O_CREAT, 0o644)
+                self._total_pid = os.getpid()
+            fcntl.flock(self._total_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._total_fd, fcntl.LOCK_UN)
+
+    def _read_total(self):
+        """Return the total size of the entries. Caller holds the lock."""
+        if self._total_path is None:
+            return self._total
+        return int(os.pread(self._total_fd, 32, 0) or 0)
+
+    def _write_total(self, total):
+        """Record the total size of the entries. Caller holds the lock."""
+        if self._total_path is None:
+            self._total = total
+            return
+        os.ftruncate(self._total_fd, 0)
+        os.pwrite(self._total_fd, str(total).encode('ascii'), 0)
+
+    def _evict(self):
+        """
+        Count the entries in the directory and remove the least recently
+        used ones while they are over the cap; return the new total. Caller
+        holds the lock.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        total = sum(size for _, _, size in entries)
+        if total <= self.max_bytes:
+            return total
+
+        # Make room for a tenth of the cap, so the next writes do not each
+        # have to scan the directory again
+        target = self.max_bytes - self.max_bytes // 10
+        for _, key, size in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(self.path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
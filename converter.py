@@ -2,252 +2,1089 @@
 Markdown to Word document converter.
 """
 
+import copy
+import io
+import itertools
+import json
+import os
 import re
-from docx import Document
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import nsdecls, qn
+from docx.oxml.shape import CT_Inline
 from docx.shared import Inches, Pt
+from docx.text.paragraph import Paragraph as DocxParagraph
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.style import WD_STYLE_TYPE
+from conversion_cache import DiskCache, content_hash
+from doc_template import DOCUMENT_PART, get_template
+from highlight import HighlightTimeout, get_highlighter
+from images import ImageRef, image_hash, prepare_images, resolve_image
+from markdown_parser import (
+    BOLD, CODE, IMAGE, ITALIC, LINK,
+    BlockLexer, BlockQuote, CodeBlock, Heading, HorizontalRule, ListBlock, Paragraph, Table,
+    block_text, iter_images, parse_blocks, spans_text,
+)
+from metrics import ConversionStats
+from lxml import etree
+
+
+# Bump whenever the generated body XML or the document styles change, so
+# cached fragments from older versions are no longer used
+FORMAT_VERSION = '4'
+
+W_R = qn('w:r')
+W_T = qn('w:t')
+W_BR = qn('w:br')
+W_TAB = qn('w:tab')
+W_DRAWING = qn('w:drawing')
+W_SECTPR = qn('w:sectPr')
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+
+def _run_property_children(style):
+    """Return the XML of the <w:rPr> children for an inline span style."""
+    children = []
+    if style & CODE:
+        children.append('<w:rFonts w:ascii="Courier New" w:hAnsi="Courier New"/>')
+    if style & BOLD:
+        children.append('<w:b/>')
+    if style & ITALIC:
+        children.append('<w:i/>')
+    if style & LINK:
+        children.append('<w:u w:val="single"/>')
+    return ''.join(children)
+
+
+# Run property templates for every combination of span styles, as elements
+# and as XML for markup built in one piece (tables)
+RUN_PROPERTY_XML = {style: f'<w:rPr>{_run_property_children(style)}</w:rPr>' for style in range(1, 16)}
+RUN_PROPERTY_XML[0] = ''
+RUN_PROPERTIES = {
+    style: parse_xml(f'<w:rPr {nsdecls("w")}>{_run_property_children(style)}</w:rPr>')
+    for style in range(1, 16)
+}
+
+# Run property templates of highlighted code, by (color, bold, italic)
+CODE_RUN_PROPERTIES = {}
+
+# Text width of a page with the python-docx default setup, in twentieths of a
+# point, for sections that do not specify their page size
+DEFAULT_TEXT_WIDTH = 8640
+
+# Picture ids as _new_inline() writes them. Sections rendered apart (on the
+# pool, from the cache or by an earlier build) each number theirs from 1, so
+# streamed packages renumber them; Word rejects repeated ids
+DOC_PR_ID_RE = re.compile(rb'<wp:docPr id="\d+" name="Picture \d+"')
+
+# Shared process pool for parallel conversion, created on first use
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+# Per-process converters used by pool workers, by (template path, highlight
+# style, CPU budget); workers convert one file at a time
+_worker_converters = {}
+
+
+def setup_styles(document):
+    """Set up the styles of the default template."""
+    styles = document.styles
+
+    # Modify the Normal style
+    normal_style = styles['Normal']
+    normal_style.font.name = 'Calibri'
+    normal_style.font.size = Pt(11)
+
+
+def _text_width(template):
+    """Width between the page margins of a template's last section, in twips."""
+    page_width, left_margin, right_margin = template.page_setup()
+    if page_width is None or left_margin is None or right_margin is None:
+        return DEFAULT_TEXT_WIDTH
+    return (page_width - left_margin - right_margin) // 635
+
+
+def _code_run_properties(style):
+    """Return the <w:rPr> template for a (color, bold, italic) code token style."""
+    rpr = CODE_RUN_PROPERTIES.get(style)
+    if rpr is None:
+        color, bold, italic = style
+        rpr = CODE_RUN_PROPERTIES[style] = parse_xml(
+            f'<w:rPr {nsdecls("w")}><w:rFonts w:ascii="Courier New" w:hAnsi="Courier New"/>'
+            + ('<w:b/>' if bold else '')
+            + ('<w:i/>' if italic else '')
+            + (f'<w:color w:val="{color.lstrip("#").upper()}"/>' if color else '')
+            + '<w:sz w:val="20"/></w:rPr>'
+        )
+    return rpr
+
+
+def _append_run_text(r, text):
+    """Append text to a <w:r>, as python-docx does for tabs and newlines."""
+    for i, line in enumerate(text.split('\n')):
+        if i:
+            etree.SubElement(r, W_BR)
+        for j, piece in enumerate(line.split('\t')):
+            if j:
+                etree.SubElement(r, W_TAB)
+            if piece:
+                t = etree.SubElement(r, W_T)
+                t.text = piece
+                if piece[0].isspace() or piece[-1].isspace():
+                    t.set(XML_SPACE, 'preserve')
+
+
+def _escape_xml(text):
+    """Escape text for use as XML character data."""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _runs_xml(spans, extra_style=0, image_xml=None):
+    """
+    Return <w:r> markup for a list of inline spans.
+
+    Args:
+        spans: List of (text, style) spans
+        extra_style: Style flags added to every span
+        image_xml: Callable returning the markup for an (Image, style) span
+    """
+    runs = []
+    for text, style in spans:
+        if style & IMAGE:
+            runs.append(image_xml(text, (style | extra_style) & ~IMAGE))
+            continue
+        text = _escape_xml(text).replace('\t', '</w:t><w:tab/><w:t>')
+        runs.append(f'<w:r>{RUN_PROPERTY_XML[style | extra_style]}<w:t>{text}</w:t></w:r>')
+    return ''.join(runs)
+
+
+def _preserve_spaces(element):
+    """
+    Mark the <w:t> elements under element whose text starts or ends with
+    whitespace as xml:space="preserve".
+
+    Markup from _runs_xml leaves the attribute out and this adds it once
+    the markup is in the document: lxml takes time quadratic in the number
+    of xml: attributes to move a parsed tree into another document.
+    """
+    for t in element.iter(W_T):
+        text = t.text
+        if text and (text[0].isspace() or text[-1].isspace()):
+            t.set(XML_SPACE, 'preserve')
+
+
+def _clear_body(body):
+    """
+    Remove all content of a <w:body>, leaving its <w:sectPr>.
+
+    Elements are emptied before they are detached: lxml moves a detached
+    subtree to a new document node by node, which takes quadratic time for
+    big elements such as large tables.
+    """
+    for element in body.xpath('./*[not(self::w:sectPr)]'):
+        element.clear()
+        body.remove(element)
+
+
+def manifest_path(output_path):
+    """Return the path of the section manifest stored next to an output."""
+    return output_path + '.manifest.json'
+
+
+def load_manifest(output_path):
+    """Load the section manifest of an output, or None if there is none."""
+    try:
+        with open(manifest_path(output_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _saved_parts(document):
+    """Save a document and return all its parts except word/document.xml."""
+    buffer = io.BytesIO()
+    document.save(buffer)
+    with zipfile.ZipFile(buffer) as source:
+        return [
+            (info, source.read(info.filename))
+            for info in source.infolist()
+            if info.filename != DOCUMENT_PART
+        ]
+
+
+def _content(md_file):
+    """Return the markdown text of a markdown file dict."""
+    content = md_file['content']
+    return content() if callable(content) else content
+
+
+def _section_key(md_file):
+    """
+    Return the key of what a markdown file's body XML is rendered from: its
+    content hash, combined with the images it embeds, if any.
+    """
+    content_key = md_file.get('hash') or content_hash(_content(md_file))
+    images = md_file.get('images')
+    if not images:
+        return content_key
+    return DiskCache.key(content_key, *(
+        f'{src}\0{ref.rid}\0{ref.cx}\0{ref.cy}' for src, ref in sorted(images.items())
+    ))
+
+
+def _pool_payload(md_file):
+    """Strip a markdown file dict down to what a pool worker needs."""
+    if 'blocks' in md_file:
+        payload = {'blocks': md_file['blocks']}
+    else:
+        payload = {'content': _content(md_file)}
+    if md_file.get('images'):
+        payload['images'] = md_file['images']
+    if md_file.get('degraded'):
+        payload['degraded'] = True
+    return payload
+
+
+def _get_pool(workers):
+    """Return the shared process pool, resizing it if needed."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_workers = workers
+        return _pool
+
+
+def _render_fragment_worker(md_file, template_path=None, highlight_style='default', cpu_budget=None,
+                            total_cpu_budget=None):
+    """
+    Process pool entry point: convert one markdown file to body XML, within
+    what was left of the conversion's total CPU budget when it was submitted.
+
+    Returns:
+        Tuple of the body XML, whether the CPU budget ran out and the CPU
+        seconds the file took
+    """
+    started = time.thread_time()
+    options = (template_path, highlight_style, cpu_budget)
+    converter = _worker_converters.get(options)
+    if converter is None:
+        template = get_template(template_path) if template_path else None
+        converter = _worker_converters[options] = MarkdownToWordConverter(
+            template=template, highlight_style=highlight_style, cpu_budget=cpu_budget
+        )
+        converter._new_document()
+    converter._total_deadline = None if total_cpu_budget is None else started + total_cpu_budget
+    fragment = converter._render_content(md_file)
+    return fragment, converter.degraded, time.thread_time() - started
+
+
+class ConverterEngine:
+    """
+    Everything conversions share: the document template, the highlighter,
+    the fragment cache and the conversion options.
+
+    An engine holds no per-document state and can be used by any number of
+    threads at once, so a process only needs one. Each conversion runs in its
+    own MarkdownToWordConverter, which is cheap to create with converter().
+    """
+
+    def __init__(self, cache=None, template=None, highlight_style='default', cpu_budget=None):
+        """
+        Args:
+            cache: Optional DiskCache for converted body XML, keyed on the
+                markdown content, the rendering options and FORMAT_VERSION
+            template: Optional DocumentTemplate (e.g. from a corporate .dotx)
+                to build documents from; defaults to the shared, prewarmed
+                python-docx default template with the Normal style adjusted
+            highlight_style: Pygments style for syntax highlighting of code
+                blocks with a fence language, or None to render all code
+                plain. Highlighting is skipped if Pygments is not installed.
+            cpu_budget: Optional seconds of CPU time each markdown file may
+                take to parse and build. Once a file has used them up, the
+                rest of it is rendered as plain text, and the result is not
+                cached.
+        """
+        self.cache = cache
+        self.template = template or get_template(setup=setup_styles)
+        self.highlighter = get_highlighter(highlight_style) if highlight_style else None
+        self.cpu_budget = cpu_budget
+
+        # Text width of the template's page setup, in twips, for sizing table
+        # columns and images
+        self.text_width = _text_width(self.template)
+
+        # Identifies everything besides the markdown that the output depends on
+        self.fingerprint = self.template.fingerprint
+        if self.highlighter is not None:
+            self.fingerprint += '+' + self.highlighter.name
+
+    def converter(self, stats=None):
+        """Return a new converter for one conversion, using this engine."""
+        return MarkdownToWordConverter(engine=self, stats=stats)
 
 
 class MarkdownToWordConverter:
-    """Converts markdown content to Word document format."""
+    """
+    Converts markdown content to Word document format.
+
+    A converter holds the working document of one conversion and must not be
+    shared between threads; create one per conversion from a shared
+    ConverterEngine.
+    """
+
+    def __init__(self, cache=None, template=None, highlight_style='default', stats=None,
+                 cpu_budget=None, engine=None):
+        """
+        Args:
+            cache, template, highlight_style, cpu_budget: Options of the
+                ConverterEngine created for this converter when none is
+                given (see ConverterEngine)
+            stats: Optional ConversionStats that stage timings, element
+                counts and output sizes are recorded into; a fresh one is
+                created otherwise. Available as ``stats``.
+            engine: Optional shared ConverterEngine to convert with; the
+                other options are ignored then
+        """
+        if engine is None:
+            engine = ConverterEngine(cache, template, highlight_style, cpu_budget)
+        self.engine = engine
+        self.cache = engine.cache
+        self.template = engine.template
+        self.highlighter = engine.highlighter
+        self.cpu_budget = engine.cpu_budget
+        self.fingerprint = engine.fingerprint
 
-    def __init__(self):
         self.document = None
+        self.section_ranges = []
+        self.stats = stats if stats is not None else ConversionStats()
+
+        # Whether the file being rendered ran out of its CPU budget, and the
+        # thread CPU time at which it does (None = no budget)
+        self.degraded = False
+        self._deadline = None
+        # Thread CPU time at which the budget of the whole conversion runs out
+        self._total_deadline = None
+        # Indexes of the files of the last streamed document that ran out
+        self._degraded_sections = set()
 
-    def convert(self, markdown_files, output_path):
+        # Images of the file being rendered, by source
+        self._images = {}
+        self._shape_id = 0
+
+    def convert(self, markdown_files, output_path, streaming=False, workers=0,
+                incremental=False, resources=None, total_cpu_budget=None):
         """
         Convert multiple markdown files to a single Word document.
 
         Args:
-            markdown_files: List of dicts with 'filename' and 'content' keys
-            output_path: Path to save the output .docx file
+            markdown_files: List of dicts with a 'filename' key and either
+                'content' (markdown text, or a callable returning it, which is
+                called when the file is converted) or 'blocks' (parsed by the
+                markdown_parser module). They may also carry 'hash', the
+                content_hash() of the source, and 'fragment', the already
+                rendered body XML as bytes or a callable returning it.
+            output_path: Path or writable file object for the output .docx
+            streaming: Write each file's body XML into the package as soon as
+                it is converted instead of building one document tree, so
+                memory is bounded by the largest single file
+            workers: Convert files on a pool of this many processes and merge
+                their body XML in input order (implies streaming output)
+            incremental: Reuse the body XML of unchanged files from the
+                previous document at output_path (which must be a path) and
+                write a manifest of every file's content hash and byte range
+                in word/document.xml next to the output (implies streaming)
+            resources: Optional object whose get(path) returns the bytes of a
+                file bundled with the markdown (or a callable returning them),
+                or None. Images referenced relative to a markdown file are
+                embedded from it; without it, or for images that are not
+                bundled, the alt text is shown instead.
+            total_cpu_budget: Optional seconds of CPU time all files together
+                may take to build, on top of each file's own budget. Files
+                are cut short to plain text once it has run out. Pool
+                workers get what is left when the files are handed out and
+                their CPU time counts against it as their results arrive;
+                files no worker has started by then are rendered here.
+
+        Body XML is assembled per file (and served from the cache when one
+        is configured) whenever streaming, workers, a cache or pre-rendered
+        fragments are in use.
         """
-        self.document = Document()
-        self._setup_styles()
+        self._new_document()
+        self.stats.count('files', len(markdown_files))
+        self._total_deadline = None
+        if total_cpu_budget is not None:
+            self._total_deadline = time.thread_time() + total_cpu_budget
+
+        if resources is not None:
+            markdown_files = self._embed_images(markdown_files, resources)
+
+        if incremental:
+            self._convert_incremental(markdown_files, output_path, workers)
+            return
+
+        prerendered = any('fragment' in md_file for md_file in markdown_files)
+        if streaming or workers > 1 or self.cache is not None or prerendered:
+            self._write_package(self._iter_sections(markdown_files, workers), output_path)
+            return
 
         for i, md_file in enumerate(markdown_files):
-            # Add page break between files (except for the first one)
-            if i > 0:
-                self.document.add_page_break()
+            self._begin_section(md_file)
+            blocks = self._parse(md_file)
+            with self.stats.stage('build'):
+                # Add page break between files (except for the first one)
+                if i > 0:
+                    self.document.add_page_break()
+
+                # Add filename as a section header
+                self._add_section_header(md_file['filename'])
+
+                # Convert and add the markdown content
+                self._images = md_file.get('images') or {}
+                self._render_blocks(blocks)
+            if self.degraded:
+                self.stats.count('degraded_sections')
+
+        self._count_document()
+        with self.stats.stage('save'):
+            self.document.save(output_path)
+        self._count_output(output_path)
+
+    def _new_document(self):
+        """Start a fresh working document with the default styles."""
+        self.document = self.template.new_document()
+
+    def _begin_section(self, md_file):
+        """
+        Start the CPU budget of a markdown file, cut short by what is left of
+        the conversion's total budget.
+        """
+        self.degraded = bool(md_file.get('degraded'))
+        deadline = self._total_deadline
+        if self.cpu_budget:
+            file_deadline = time.thread_time() + self.cpu_budget
+            if deadline is None or file_deadline < deadline:
+                deadline = file_deadline
+        self._deadline = deadline
+
+    def _parse(self, md_file):
+        """Return the parsed blocks of a markdown file dict."""
+        blocks = md_file.get('blocks')
+        if blocks is None:
+            started = time.perf_counter()
+            lexer = BlockLexer(self._deadline)
+            blocks = parse_blocks(_content(md_file).split('\n'), lexer)
+            self.stats.add_time('parse', time.perf_counter() - started - lexer.inline_seconds)
+            self.stats.add_time('inline', lexer.inline_seconds)
+            if lexer.degraded:
+                self.degraded = True
+        return blocks
+
+    def _count_document(self):
+        """Count the elements of the working document's body."""
+        body = self.document.element.body
+        for name, tag in (('paragraphs', 'w:p'), ('runs', 'w:r'),
+                          ('tables', 'w:tbl'), ('images', 'w:drawing')):
+            self.stats.count(name, int(body.xpath(f'count(.//{tag})')))
+
+    def _count_output(self, output_path):
+        """Record the size of a written output path or file object."""
+        if isinstance(output_path, (str, os.PathLike)):
+            size = os.path.getsize(output_path)
+        else:
+            size = output_path.tell()
+        self.stats.count('output_bytes', size)
+
+    def _embed_images(self, markdown_files, resources):
+        """
+        Add every distinct image referenced by the markdown files and found
+        in resources to the working document, as one image part each.
+
+        Only files that can contain images are parsed here: text without
+        "![" has none, so those files are left to be parsed when they are
+        rendered, if their fragment does not come from a previous build or
+        the cache.
 
-            # Add filename as a section header
-            self._add_section_header(md_file['filename'])
+        Returns:
+            The markdown files; those parsed here are copies that carry their
+            parsed 'blocks' and an 'images' dict of image source to ImageRef
+        """
+        found = {}  # file index -> {src: image hash}
+        blobs = {}
+        markdown_files = list(markdown_files)
+        for index, md_file in enumerate(markdown_files):
+            if 'fragment' in md_file:
+                continue
+            source = md_file
+            if 'blocks' not in md_file:
+                content = _content(md_file)
+                if '![' not in content:
+                    continue
+                source = dict(md_file, content=content)
+            self._begin_section(md_file)
+            blocks = self._parse(source)
+            markdown_files[index] = dict(md_file, blocks=blocks, degraded=self.degraded)
+            sources = found[index] = {}
+            for image in iter_images(blocks):
+                if image.src in sources:
+                    continue
+                with self.stats.stage('images'):
+                    data = resolve_image(resources, md_file['filename'], image.src)
+                    if data is not None:
+                        sources[image.src] = image_hash(data)
+                        blobs.setdefault(sources[image.src], data)
+
+        if not blobs:
+            return markdown_files
+
+        # Decoding and downscaling runs on a thread pool
+        with self.stats.stage('images'):
+            refs = {
+                digest: self._add_image_part(digest, blob)
+                for digest, blob in prepare_images(blobs).items()
+                if blob is not None
+            }
+
+        for index, sources in found.items():
+            markdown_files[index]['images'] = {
+                src: refs[digest] for src, digest in sources.items() if digest in refs
+            }
+        return markdown_files
+
+    def _add_image_part(self, digest, blob):
+        """
+        Add an image part to the working document and return its ImageRef.
+
+        The relationship id is derived from the image's hash, so rendered
+        body XML stays valid in any document that embeds the same image.
+        """
+        part = self.document.part
+        image_part = part.package.get_or_add_image_part(io.BytesIO(blob))
+        rid = 'rIdImg' + digest[:16]
+        if rid not in part.rels:
+            part.rels.add_relationship(RT.IMAGE, image_part, rid)
+
+        # Native size, shrunk to the text width
+        cx, cy = image_part.image.scaled_dimensions()
+        max_cx = self.engine.text_width * 635
+        if cx > max_cx:
+            cx, cy = max_cx, cy * max_cx // cx
+        return ImageRef(rid, image_part.image.filename, int(cx), int(cy))
+
+    def _convert_incremental(self, markdown_files, output_path, workers):
+        """
+        Rebuild output_path, splicing in unchanged sections of its previous
+        word/document.xml, and record the new section byte ranges.
+        """
+        markdown_files = [
+            dict(md_file, hash=md_file.get('hash') or content_hash(_content(md_file)))
+            for md_file in markdown_files
+        ]
+
+        previous = self._previous_sections(output_path)
+        if previous:
+            markdown_files = [
+                md_file if 'fragment' in md_file or _section_key(md_file) not in previous
+                else dict(md_file, fragment=previous[_section_key(md_file)])
+                for md_file in markdown_files
+            ]
+            self.stats.count('cached_sections', sum(
+                _section_key(md_file) in previous for md_file in markdown_files
+            ))
+
+        tmp_path = output_path + '.tmp'
+        self._write_package(self._iter_sections(markdown_files, workers), tmp_path)
+        os.replace(tmp_path, output_path)
+
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'fingerprint': self.fingerprint,
+            'sources': [
+                {
+                    'filename': md_file['filename'],
+                    'hash': md_file['hash'],
+                    # Sections cut short by the CPU budget are never reused
+                    'key': None if i in self._degraded_sections else _section_key(md_file),
+                    'range': list(span),
+                }
+                for i, (md_file, span) in enumerate(zip(markdown_files, self.section_ranges))
+            ],
+        }
+        with open(manifest_path(output_path), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def _previous_sections(self, output_path):
+        """Map content hashes to body XML of the previous build of output_path."""
+        manifest = load_manifest(output_path)
+        if (not manifest or manifest.get('format_version') != FORMAT_VERSION
+                or manifest.get('fingerprint') != self.fingerprint):
+            return {}
+        try:
+            with zipfile.ZipFile(output_path) as package:
+                xml = package.read(DOCUMENT_PART)
+        except (OSError, KeyError, zipfile.BadZipFile):
+            return {}
+        return {
+            source.get('key', source['hash']): xml[source['range'][0]:source['range'][1]]
+            for source in manifest.get('sources', [])
+            if source.get('key', source['hash']) is not None
+        }
+
+    def render_fragment(self, md_file):
+        """
+        Convert one markdown file to its content body XML (without the
+        section header), using the cache when one is configured.
+
+        Args:
+            md_file: Dict as accepted by convert()
+
+        Returns:
+            The body XML as bytes; degraded tells afterwards whether the file
+            ran out of its CPU budget
+        """
+        if self.document is None:
+            self._new_document()
+        # Cached fragments are complete, however far the upload's lexer got
+        self.degraded = False
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(md_file)
+            fragment = self.cache.get(key)
+            if fragment is not None:
+                self.stats.count('cached_sections')
+                return fragment
+        fragment = self._render_content(md_file)
+        if key is not None and not self.degraded:
+            self.cache.put(key, fragment)
+        return fragment
+
+    def _cache_key(self, md_file):
+        """Return the fragment cache key of a markdown file."""
+        return self.cache.key(
+            FORMAT_VERSION,
+            self.fingerprint,
+            _section_key(md_file),
+        )
+
+    def _iter_sections(self, markdown_files, workers=0):
+        """
+        Yield the section header and content body XML of each markdown file
+        in input order.
+
+        Content fragments come from the file itself or the cache when
+        possible; cached ones are read as their turn comes, so only one is
+        held at a time. Misses are converted on the process pool when
+        workers > 1, otherwise lazily in-process so only one section is built
+        at a time.
+        """
+        pool = _get_pool(workers) if workers > 1 and len(markdown_files) > 1 else None
+
+        pending = []
+        for md_file in markdown_files:
+            key = None
+            fragment = md_file.get('fragment')
+            if fragment is None and self.cache is not None:
+                key = self._cache_key(md_file)
+                if self.cache.get_path(key) is not None:
+                    fragment = partial(self.cache.get, key)
+                    self.stats.count('cached_sections')
+            if fragment is None and pool is not None:
+                fragment = pool.submit(
+                    _render_fragment_worker,
+                    _pool_payload(md_file),
+                    self.template.path,
+                    self.highlighter and self.highlighter.name,
+                    self.cpu_budget,
+                    None if self._total_deadline is None else self._total_deadline - time.thread_time(),
+                )
+            pending.append((key, fragment))
+
+        self._degraded_sections = set()
+        for index, (md_file, (key, fragment)) in enumerate(zip(markdown_files, pending)):
+            if callable(fragment):
+                # None if the cache entry was evicted since it was found
+                fragment = fragment()
+            if isinstance(fragment, Future) and fragment.cancelled():
+                # The total budget ran out before a worker took it up
+                fragment = None
+            if fragment is None or isinstance(fragment, Future):
+                if fragment is None:
+                    fragment = self._render_content(md_file)
+                    degraded = self.degraded
+                else:
+                    # Waiting for a pool worker counts as building
+                    with self.stats.stage('build'):
+                        fragment, degraded, cpu_seconds = fragment.result()
+                    if self._total_deadline is not None:
+                        self._total_deadline -= cpu_seconds
+                        if time.thread_time() > self._total_deadline:
+                            for _, later in pending[index + 1:]:
+                                if isinstance(later, Future):
+                                    later.cancel()
+                    if degraded:
+                        self.stats.count('degraded_sections')
+                if degraded:
+                    self._degraded_sections.add(index)
+                elif key is not None:
+                    self.cache.put(key, fragment)
+            yield self._render_header(md_file['filename']), fragment
+
+    def _render_header(self, filename):
+        """Return the body XML of a section header."""
+        with self.stats.stage('build'):
+            self._add_section_header(filename)
+        with self.stats.stage('serialize'):
+            return self._take_body_xml()
+
+    def _render_content(self, md_file):
+        """
+        Convert a markdown file's content and return its body XML.
+
+        The generated elements are removed from the document again, so the
+        working tree never holds more than one section.
+        """
+        self._begin_section(md_file)
+        blocks = self._parse(md_file)
+        with self.stats.stage('build'):
+            self._images = md_file.get('images') or {}
+            self._render_blocks(blocks)
+        if self.degraded:
+            self.stats.count('degraded_sections')
+        with self.stats.stage('serialize'):
+            return self._take_body_xml()
+
+    def _take_body_xml(self):
+        """Serialize and clear the body content of the working document."""
+        body = self.document.element.body
+        xml = etree.tostring(body, encoding='UTF-8')
+        _clear_body(body)
+        # Namespaces are declared once on <w:body>; keep only its children
+        return xml[xml.index(b'>') + 1:xml.rindex(b'<w:sectPr')]
+
+    def _write_package(self, sections, output_path):
+        """
+        Write a .docx package whose body is streamed from XML fragments.
+
+        Args:
+            sections: Iterable of (header, content) body XML pairs, one per
+                source file
+            output_path: Path or writable file object for the output .docx
+
+        The byte range of each section's content within word/document.xml is
+        left in ``section_ranges``. Picture ids are numbered across the
+        whole document as the sections are written. Only the time spent
+        writing (and compressing) counts as the save stage; producing the
+        sections is timed where they are rendered.
+        """
+        body = self.document.element.body
+        body.clear_content()
+        body.get_or_add_sectPr()
+
+        self.document.add_page_break()
+        page_break = self._take_body_xml()
+
+        xml = etree.tostring(self.document.element, encoding='UTF-8', standalone=True)
+        body_start = xml.index(b'<w:body>') + len(b'<w:body>')
+        head, tail = xml[:body_start], xml[xml.rindex(b'<w:sectPr'):]
 
-            # Convert and add the markdown content
-            self._convert_markdown(md_file['content'])
+        shape_ids = itertools.count(1)
 
-        self.document.save(output_path)
+        def number_shape(match):
+            shape_id = next(shape_ids)
+            return b'<wp:docPr id="%d" name="Picture %d"' % (shape_id, shape_id)
 
-    def _setup_styles(self):
-        """Set up document styles."""
-        styles = self.document.styles
+        stats = self.stats
+        started = time.perf_counter()
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as package:
+            self.section_ranges = []
+            with package.open(DOCUMENT_PART, 'w') as part:
+                part.write(head)
+                offset = len(head)
+                stats.add_time('save', time.perf_counter() - started)
+                for i, (header, content) in enumerate(sections):
+                    if i > 0:
+                        stats.count_body_xml(page_break)
+                    stats.count_body_xml(header)
+                    stats.count_body_xml(content)
+                    started = time.perf_counter()
+                    if b'<wp:docPr ' in content:
+                        content = DOC_PR_ID_RE.sub(number_shape, content)
+                    if i > 0:
+                        part.write(page_break)
+                        offset += len(page_break)
+                    part.write(header)
+                    part.write(content)
+                    offset += len(header)
+                    self.section_ranges.append((offset, offset + len(content)))
+                    offset += len(content)
+                    stats.add_time('save', time.perf_counter() - started)
+                started = time.perf_counter()
+                part.write(tail)
 
-        # Modify the Normal style
-        normal_style = styles['Normal']
-        normal_style.font.name = 'Calibri'
-        normal_style.font.size = Pt(11)
+            # Every other part comes from the template, unless the working
+            # document gained parts of its own
+            if len(self.document.part.rels) == self.template.relationship_count():
+                parts = self.template.package_parts()
+            else:
+                parts = _saved_parts(self.document)
+            for info, data in parts:
+                package.writestr(info, data)
+        stats.add_time('save', time.perf_counter() - started)
+        self._count_output(output_path)
 
     def _add_section_header(self, filename):
         """Add a section header showing the source filename."""
         # Remove .md extension for cleaner display
         display_name = filename.rsplit('.', 1)[0] if '.' in filename else filename
 
-        para = self.document.add_paragraph()
+        para = self._add_body_paragraph()
         run = para.add_run(f"Source: {display_name}")
         run.italic = True
         run.font.size = Pt(10)
         para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
 
         # Add a horizontal line
-        self.document.add_paragraph('─' * 50)
-
-    def _convert_markdown(self, content):
-        """Convert markdown content to Word document elements."""
-        lines = content.split('\n')
-        i = 0
-        in_code_block = False
-        code_block_content = []
-
-        while i < len(lines):
-            line = lines[i]
-
-            # Handle code blocks
-            if line.strip().startswith('```'):
-                if in_code_block:
-                    # End of code block
-                    self._add_code_block('\n'.join(code_block_content))
-                    code_block_content = []
-                    in_code_block = False
-                else:
-                    # Start of code block
-                    in_code_block = True
-                i += 1
-                continue
+        self._add_body_paragraph('─' * 50)
 
-            if in_code_block:
-                code_block_content.append(line)
-                i += 1
-                continue
+    def _append_to_body(self, element):
+        """
+        Append a block element to the body of the working document.
 
-            # Handle headers
-            if line.startswith('#'):
-                self._add_header(line)
-                i += 1
-                continue
+        It goes right before the trailing <w:sectPr>, found from the end:
+        python-docx searches all body children for it on every paragraph or
+        table it adds, which makes building a long document quadratic.
+        """
+        body = self.document.element.body
+        last = next(body.iterchildren(reversed=True), None)
+        if last is not None and last.tag == W_SECTPR:
+            last.addprevious(element)
+        else:
+            body.append(element)
+        return element
 
-            # Handle horizontal rules
-            if re.match(r'^(\*{3,}|-{3,}|_{3,})\s*$', line.strip()):
-                self.document.add_paragraph('─' * 50)
-                i += 1
-                continue
+    def _add_body_paragraph(self, text=''):
+        """Add a paragraph to the working document, like Document.add_paragraph."""
+        para = DocxParagraph(self._append_to_body(OxmlElement('w:p')), self.document._body)
+        if text:
+            para.add_run(text)
+        return para
 
-            # Handle unordered lists
-            if re.match(r'^\s*[-*+]\s+', line):
-                list_items = []
-                while i < len(lines) and re.match(r'^\s*[-*+]\s+', lines[i]):
-                    list_items.append(lines[i])
-                    i += 1
-                self._add_unordered_list(list_items)
-                continue
+    def _render_blocks(self, blocks):
+        """Emit Word document elements for a list of parsed block nodes."""
+        handlers = {
+            Heading: self._add_header,
+            Paragraph: self._add_paragraph,
+            CodeBlock: self._add_code_block,
+            ListBlock: self._add_list,
+            BlockQuote: self._add_blockquote,
+            HorizontalRule: self._add_horizontal_rule,
+            Table: self._add_table,
+        }
+        deadline = self._deadline
+        plain = False
+        for block in blocks:
+            if deadline is not None and not plain and time.thread_time() > deadline:
+                # Out of CPU budget: the rest of the file is shown as plain text
+                plain = self.degraded = True
+            if plain:
+                self._add_plain_paragraph(block_text(block))
+            else:
+                handlers[type(block)](block)
 
-            # Handle ordered lists
-            if re.match(r'^\s*\d+\.\s+', line):
-                list_items = []
-                while i < len(lines) and re.match(r'^\s*\d+\.\s+', lines[i]):
-                    list_items.append(lines[i])
-                    i += 1
-                self._add_ordered_list(list_items)
-                continue
+    def _add_plain_paragraph(self, text):
+        """Add unformatted text as one paragraph, with line breaks and tabs."""
+        para = self._add_body_paragraph()
+        if text:
+            _append_run_text(etree.SubElement(para._p, W_R), text)
 
-            # Handle blockquotes
-            if line.startswith('>'):
-                quote_lines = []
-                while i < len(lines) and lines[i].startswith('>'):
-                    quote_lines.append(lines[i])
-                    i += 1
-                self._add_blockquote(quote_lines)
-                continue
+    def _add_header(self, heading):
+        """Add a header to the document."""
+        level = heading.level
+        text = heading.text
+
+        # Map markdown levels to Word heading styles
+        heading_style = f'Heading {min(level, 9)}'
+
+        style_id = self.template.style_id(heading_style)
+        if style_id is not None:
+            para = self._add_body_paragraph(text)
+            para._p.style = style_id
+        else:
+            # Fallback if heading style doesn't exist
+            para = self._add_body_paragraph()
+            run = para.add_run(text)
+            run.bold = True
+            run.font.size = Pt(16 - level)
+
+    def _add_horizontal_rule(self, rule):
+        """Add a horizontal rule to the document."""
+        self._add_body_paragraph('─' * 50)
+
+    def _add_paragraph(self, paragraph):
+        """Add a paragraph with inline formatting."""
+        para = self._add_body_paragraph()
+        self._add_formatted_text(para, paragraph.spans)
+
+    def _add_formatted_text(self, para, spans):
+        """
+        Add inline spans to a paragraph as runs (bold, italic, code, link).
 
-            # Handle regular paragraphs
-            if line.strip():
-                # Collect paragraph lines until empty line
-                para_lines = []
-                while i < len(lines) and lines[i].strip() and not lines[i].startswith('#'):
-                    if re.match(r'^\s*[-*+]\s+', lines[i]) or re.match(r'^\s*\d+\.\s+', lines[i]):
-                        break
-                    if lines[i].startswith('>'):
-                        break
-                    if lines[i].strip().startswith('```'):
-                        break
-                    para_lines.append(lines[i])
-                    i += 1
-                self._add_paragraph(' '.join(para_lines))
+        Runs are appended as raw <w:r> elements with a copy of the prebuilt
+        run properties for their style, which is much cheaper than going
+        through the python-docx run API.
+        """
+        p = para._p
+        deadline = self._deadline
+        for i, (text, style) in enumerate(spans):
+            if deadline is not None and not i & 63 and time.thread_time() > deadline:
+                # Out of CPU budget: the rest of the paragraph is one plain run
+                self.degraded = True
+                self._add_run(para, spans_text(spans[i:]), 0)
+                break
+            if style & IMAGE:
+                self._add_image(para, text, style & ~IMAGE)
+                continue
+            if '\t' in text or '\n' in text:
+                # python-docx translates these into <w:tab/> and <w:br/>
+                self._add_run(para, text, style)
                 continue
+            r = etree.SubElement(p, W_R)
+            if style:
+                r.append(copy.deepcopy(RUN_PROPERTIES[style]))
+            t = etree.SubElement(r, W_T)
+            t.text = text
+            if text[:1].isspace() or text[-1:].isspace():
+                t.set(XML_SPACE, 'preserve')
 
-            i += 1
+    def _add_image(self, para, image, style):
+        """Add an inline image to a paragraph, or its alt text if not bundled."""
+        ref = self._images.get(image.src)
+        if ref is None:
+            self._add_formatted_text(para, [(image.alt or image.src, style)])
+            return
+        r = etree.SubElement(para._p, W_R)
+        etree.SubElement(r, W_DRAWING).append(self._new_inline(ref))
 
-    def _add_header(self, line):
-        """Add a header to the document."""
-        # Count the number of # symbols
-        match = re.match(r'^(#{1,6})\s+(.+)$', line)
-        if match:
-            level = len(match.group(1))
-            text = match.group(2).strip()
+    def _image_xml(self, image, style):
+        """Return the run markup of an inline image, or of its alt text."""
+        ref = self._images.get(image.src)
+        if ref is None:
+            return _runs_xml([(image.alt or image.src, style)])
+        inline = etree.tostring(self._new_inline(ref), encoding='unicode')
+        return f'<w:r><w:drawing>{inline}</w:drawing></w:r>'
 
-            # Map markdown levels to Word heading styles
-            heading_style = f'Heading {min(level, 9)}'
+    def _new_inline(self, ref):
+        """Build the <wp:inline> picture element for an image."""
+        self._shape_id += 1
+        return CT_Inline.new_pic_inline(self._shape_id, ref.rid, ref.filename, ref.cx, ref.cy)
 
-            try:
-                para = self.document.add_paragraph(text, style=heading_style)
-            except KeyError:
-                # Fallback if heading style doesn't exist
-                para = self.document.add_paragraph()
-                run = para.add_run(text)
-                run.bold = True
-                run.font.size = Pt(16 - level)
-
-    def _add_paragraph(self, text):
-        """Add a paragraph with inline formatting."""
-        para = self.document.add_paragraph()
-        self._add_formatted_text(para, text)
-
-    def _add_formatted_text(self, para, text):
-        """Add text to a paragraph with inline formatting (bold, italic, code)."""
-        # Pattern to match inline formatting
-        pattern = r'(\*\*\*(.+?)\*\*\*|\*\*(.+?)\*\*|\*(.+?)\*|__(.+?)__|_(.+?)_|`(.+?)`|\[(.+?)\]\((.+?)\))'
-
-        last_end = 0
-        for match in re.finditer(pattern, text):
-            # Add text before the match
-            if match.start() > last_end:
-                para.add_run(text[last_end:match.start()])
-
-            full_match = match.group(0)
-
-            if match.group(2):  # Bold and italic ***text***
-                run = para.add_run(match.group(2))
-                run.bold = True
-                run.italic = True
-            elif match.group(3):  # Bold **text**
-                run = para.add_run(match.group(3))
-                run.bold = True
-            elif match.group(4):  # Italic *text*
-                run = para.add_run(match.group(4))
-                run.italic = True
-            elif match.group(5):  # Bold __text__
-                run = para.add_run(match.group(5))
-                run.bold = True
-            elif match.group(6):  # Italic _text_
-                run = para.add_run(match.group(6))
-                run.italic = True
-            elif match.group(7):  # Inline code `text`
-                run = para.add_run(match.group(7))
-                run.font.name = 'Courier New'
-            elif match.group(8) and match.group(9):  # Link [text](url)
-                run = para.add_run(f"{match.group(8)} ({match.group(9)})")
-                run.underline = True
-
-            last_end = match.end()
-
-        # Add any remaining text
-        if last_end < len(text):
-            para.add_run(text[last_end:])
-
-    def _add_code_block(self, code):
-        """Add a code block to the document."""
-        para = self.document.add_paragraph()
+    def _add_run(self, para, text, style):
+        """Add a single styled run through python-docx."""
+        run = para.add_run(text)
+        if style & BOLD:
+            run.bold = True
+        if style & ITALIC:
+            run.italic = True
+        if style & CODE:
+            run.font.name = 'Courier New'
+        if style & LINK:
+            run.underline = True
+
+    def _add_code_block(self, block):
+        """Add a code block to the document, highlighted if possible."""
+        para = self._add_body_paragraph()
         para.paragraph_format.left_indent = Inches(0.5)
-        run = para.add_run(code)
+
+        spans = None
+        if self.highlighter is not None:
+            try:
+                spans = self.highlighter.highlight(block.code, block.language)
+            except HighlightTimeout:
+                # Plain this time only, so the section must not be cached
+                self.degraded = True
+        if spans:
+            p = para._p
+            for text, style in spans:
+                r = etree.SubElement(p, W_R)
+                r.append(copy.deepcopy(_code_run_properties(style)))
+                _append_run_text(r, text)
+            return
+
+        run = para.add_run(block.code)
         run.font.name = 'Courier New'
         run.font.size = Pt(10)
 
-    def _add_unordered_list(self, items):
-        """Add an unordered list to the document."""
-        for item in items:
-            # Extract the text after the bullet
-            text = re.sub(r'^\s*[-*+]\s+', '', item)
-            para = self.document.add_paragraph(style='List Bullet')
-            self._add_formatted_text(para, text)
-
-    def _add_ordered_list(self, items):
-        """Add an ordered list to the document."""
-        for item in items:
-            # Extract the text after the number
-            text = re.sub(r'^\s*\d+\.\s+', '', item)
-            para = self.document.add_paragraph(style='List Number')
-            self._add_formatted_text(para, text)
-
-    def _add_blockquote(self, lines):
-        """Add a blockquote to the document."""
-        # Combine lines and remove > prefix
-        text_lines = []
-        for line in lines:
-            text_lines.append(re.sub(r'^>\s*', '', line))
-        text = ' '.join(text_lines)
+    def _add_list(self, block):
+        """Add an ordered or unordered list to the document."""
+        style_id = self.template.style_id('List Number' if block.ordered else 'List Bullet')
+        for spans in block.items:
+            para = self._add_body_paragraph()
+            if style_id is not None:
+                para._p.style = style_id
+            self._add_formatted_text(para, spans)
 
-        para = self.document.add_paragraph()
+    def _add_table(self, table):
+        """
+        Add a table to the document.
+
+        The whole <w:tbl> is built as markup and parsed in one go; adding
+        rows and cells through python-docx gets slower with every row.
+        """
+        columns = len(table.align)
+        width = self.engine.text_width // columns
+        cell_start = f'<w:tc><w:tcPr><w:tcW w:w="{width}" w:type="dxa"/></w:tcPr><w:p>'
+        paragraph_properties = [
+            f'<w:pPr><w:jc w:val="{align}"/></w:pPr>' if align else ''
+            for align in table.align
+        ]
+
+        style_id = self.template.style_id('Table Grid', WD_STYLE_TYPE.TABLE)
+        parts = [
+            f'<w:tbl {nsdecls("w")}><w:tblPr>',
+            f'<w:tblStyle w:val="{style_id}"/>' if style_id else '',
+            '<w:tblW w:w="0" w:type="auto"/>'
+            '<w:tblLook w:val="04A0" w:firstRow="1" w:lastRow="0" w:firstColumn="1"'
+            ' w:lastColumn="0" w:noHBand="0" w:noVBand="1"/></w:tblPr><w:tblGrid>',
+            f'<w:gridCol w:w="{width}"/>' * columns,
+            '</w:tblGrid>',
+        ]
+        append = parts.append
+
+        # The header row is bold and repeated on every page
+        append('<w:tr><w:trPr><w:tblHeader/></w:trPr>')
+        for properties, cell in zip(paragraph_properties, table.header):
+            append(cell_start + properties + _runs_xml(cell, BOLD, self._image_xml) + '</w:p></w:tc>')
+        append('</w:tr>')
+
+        deadline = self._deadline
+        plain = False
+        for i, row in enumerate(table.rows):
+            if deadline is not None and not plain and not i & 63 and time.thread_time() > deadline:
+                # Out of CPU budget: the remaining rows are plain text
+                plain = self.degraded = True
+            append('<w:tr>')
+            for properties, cell in zip(paragraph_properties, row):
+                if plain:
+                    cell = [(spans_text(cell), 0)]
+                append(cell_start + properties + _runs_xml(cell, 0, self._image_xml) + '</w:p></w:tc>')
+            append('</w:tr>')
+        append('</w:tbl>')
+
+        _preserve_spaces(self._append_to_body(parse_xml(''.join(parts))))
+
+    def _add_blockquote(self, quote):
+        """Add a blockquote to the document."""
+        para = self._add_body_paragraph()
         para.paragraph_format.left_indent = Inches(0.5)
         para.paragraph_format.right_indent = Inches(0.5)
-        run = para.add_run(text)
+        run = para.add_run(quote.text)
         run.italic = True
@@ -0,0 +1,158 @@
+"""
+Prewarmed Word document templates.
+
+Loading the default python-docx template (or a corporate .dotx) means
+unzipping and parsing the whole package. A DocumentTemplate does that once
+per process and hands out deep copies, along with the style ids and static
+package parts that every conversion needs. Templates are shared by all
+threads; the prototype is only ever read under the template's lock.
+"""
+
+import copy
+import hashlib
+import io
+import threading
+import zipfile
+
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+
+
+DOCUMENT_PART = 'word/document.xml'
+CONTENT_TYPES_PART = '[Content_Types].xml'
+
+TEMPLATE_MAIN_CT = b'application/vnd.openxmlformats-officedocument.wordprocessingml.template.main+xml'
+DOCUMENT_MAIN_CT = b'application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml'
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(path=None, setup=None):
+    """
+    Return the shared template for path, loading it on first use.
+
+    Args:
+        path: .docx or .dotx file to base documents on, or None for the
+            python-docx default template
+        setup: Optional callable applied to the prototype document once
+            after loading (e.g. to adjust styles)
+    """
+    key = (path, setup)
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is None:
+            template = _templates[key] = DocumentTemplate(path, setup)
+        return template
+
+
+def _load_document(path):
+    """Open a .docx or .dotx file as a python-docx Document."""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    # python-docx refuses templates, but a .dotx only differs from a .docx
+    # in the content type of its main part
+    package = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(data)) as source:
+        with zipfile.ZipFile(package, 'w', zipfile.ZIP_DEFLATED) as target:
+            for info in source.infolist():
+                part = source.read(info.filename)
+                if info.filename == CONTENT_TYPES_PART:
+                    part = part.replace(TEMPLATE_MAIN_CT, DOCUMENT_MAIN_CT)
+                target.writestr(info, part)
+    return Document(package), hashlib.sha256(data).hexdigest()
+
+
+class DocumentTemplate:
+    """A parsed base document that working documents are cloned from."""
+
+    def __init__(self, path=None, setup=None):
+        """
+        Args:
+            path: .docx or .dotx file to base documents on, or None for the
+                python-docx default template
+            setup: Optional callable applied to the prototype once
+        """
+        self.path = path
+        if path is None:
+            self._prototype = Document()
+            self.fingerprint = 'default'
+        else:
+            self._prototype, self.fingerprint = _load_document(path)
+            # Boilerplate content of the template is not carried over,
+            # only its styles and page setup
+            self._prototype.element.body.clear_content()
+        self._prototype.element.body.get_or_add_sectPr()
+        if setup is not None:
+            setup(self._prototype)
+
+        self._style_ids = {}
+        self._package_parts = None
+        self._lock = threading.Lock()
+
+    def new_document(self):
+        """Return a fresh copy of the prototype document."""
+        with self._lock:
+            return copy.deepcopy(self._prototype)
+
+    def style_id(self, name, style_type=WD_STYLE_TYPE.PARAGRAPH):
+        """
+        Return the id of the style with the given name and type (paragraph
+        by default), or None if the template does not define it.
+        """
+        try:
+            return self._style_ids[name, style_type]
+        except KeyError:
+            pass
+        with self._lock:
+            try:
+                style = self._prototype.styles[name]
+                style_id = style.style_id if style.type == style_type else None
+            except KeyError:
+                style_id = None
+        self._style_ids[name, style_type] = style_id
+        return style_id
+
+    def page_setup(self):
+        """
+        Return the page width and left and right margins of the prototype's
+        last section, in EMU (None where the template does not set them).
+        """
+        with self._lock:
+            section = self._prototype.sections[-1]
+            return section.page_width, section.left_margin, section.right_margin
+
+    def relationship_count(self):
+        """Number of relationships of the prototype's main document part."""
+        return len(self._prototype.part.rels)
+
+    def package_parts(self):
+        """
+        Return the (ZipInfo, bytes) of every package part except
+        word/document.xml, serialized once from the prototype.
+
+        The ZipInfo objects are new on every call: ZipFile.writestr() fills
+        in their offsets, CRCs and sizes, so conversions writing at the same
+        time must not share them.
+        """
+        with self._lock:
+            if self._package_parts is None:
+                package = io.BytesIO()
+                self._prototype.save(package)
+                with zipfile.ZipFile(package) as source:
+                    self._package_parts = [
+                        (info.filename, info.date_time, info.compress_type,
+                         info.external_attr, source.read(info.filename))
+                        for info in source.infolist()
+                        if info.filename != DOCUMENT_PART
+                    ]
+            parts = self._package_parts
+
+        result = []
+        for filename, date_time, compress_type, external_attr, data in parts:
+            info = zipfile.ZipInfo(filename, date_time)
+            info.compress_type = compress_type
+            info.external_attr = external_attr
+            result.append((info, data))
+        return result
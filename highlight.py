@@ -0,0 +1,162 @@
+"""
+Syntax highlighting of fenced code blocks.
+
+Pygments is optional: without it, for unknown languages and for blocks that
+cannot be tokenized within the time budget, code blocks are rendered plain.
+Token streams are cached per (language, code hash), so repeated snippets are
+only tokenized once per process. Blocks that ran out of time are not: the
+next conversion tries them again.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+# Seconds of CPU time a single block may spend in the tokenizer before it is
+# rendered plain
+TIME_BUDGET = 0.25
+
+# Blocks larger than this are never highlighted
+MAX_CODE_CHARS = 200 * 1024
+
+# Number of tokenized blocks kept in memory
+CACHE_SIZE = 2048
+
+# Style of untokenized code and whitespace: (color, bold, italic)
+PLAIN = (None, False, False)
+
+_highlighters = {}
+_highlighters_lock = threading.Lock()
+
+
+class HighlightTimeout(Exception):
+    """A code block could not be tokenized within its time budget."""
+
+
+def get_highlighter(style='default'):
+    """
+    Return the shared highlighter for a Pygments style, or None if Pygments
+    is not installed or does not know the style.
+    """
+    with _highlighters_lock:
+        if style not in _highlighters:
+            try:
+                from pygments.styles import get_style_by_name
+                from pygments.util import ClassNotFound
+            except ImportError:
+                _highlighters[style] = None
+            else:
+                try:
+                    _highlighters[style] = Highlighter(style, get_style_by_name(style))
+                except ClassNotFound:
+                    _highlighters[style] = None
+        return _highlighters[style]
+
+
+class Highlighter:
+    """Tokenizes code into colored spans using one Pygments style."""
+
+    def __init__(self, name, style):
+        """
+        Args:
+            name: Name of the Pygments style
+            style: The Pygments style class
+        """
+        self.name = name
+        self._style = style
+        self._token_styles = {}
+        self._lexers = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def highlight(self, code, language, budget=TIME_BUDGET):
+        """
+        Split code into highlighted spans.
+
+        Args:
+            code: Source code of the block
+            language: Fence language (e.g. 'python'), or None
+            budget: Seconds of CPU time the tokenizer may take before giving
+                up, in which case HighlightTimeout is raised
+
+        Returns:
+            List of (text, (color, bold, italic)) spans, where color is a hex
+            RGB string or None, with adjacent spans of the same style merged;
+            or None if the block should be rendered plain
+        """
+        if not language or not code or len(code) > MAX_CODE_CHARS:
+            return None
+
+        key = (language, hashlib.sha256(code.encode('utf-8')).digest())
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        lexer = self._lexer(language)
+        spans = None if lexer is None else self._tokenize(lexer, code, budget)
+
+        # Unknown languages are cached too; timeouts raise and are not, since
+        # another try may well finish in time
+        with self._lock:
+            self._cache[key] = spans
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return spans
+
+    def _lexer(self, language):
+        """Return the (shared) Pygments lexer for a language, or None."""
+        try:
+            return self._lexers[language]
+        except KeyError:
+            pass
+        from pygments.lexers import get_lexer_by_name
+        from pygments.util import ClassNotFound
+
+        try:
+            # Keep the code exactly as written
+            lexer = get_lexer_by_name(language, stripnl=False, ensurenl=False)
+        except ClassNotFound:
+            lexer = None
+        self._lexers[language] = lexer
+        return lexer
+
+    def _tokenize(self, lexer, code, budget):
+        """
+        Tokenize code, raising HighlightTimeout if that takes more than
+        budget seconds of the thread's CPU time. Wall time would also count
+        the time other threads hold the GIL.
+        """
+        deadline = time.thread_time() + budget
+        spans = []
+        pieces = []
+        current = PLAIN
+        for i, (token_type, text) in enumerate(lexer.get_tokens(code)):
+            if not i & 63 and time.thread_time() > deadline:
+                raise HighlightTimeout(lexer.name)
+            if text.isspace():
+                # Whitespace takes on the style of whatever precedes it
+                style = current
+            else:
+                style = self._token_style(token_type)
+            if style != current and pieces:
+                spans.append((''.join(pieces), current))
+                pieces = []
+            current = style
+            pieces.append(text)
+        if pieces:
+            spans.append((''.join(pieces), current))
+        return spans
+
+    def _token_style(self, token_type):
+        """Return the (color, bold, italic) style of a token type."""
+        try:
+            return self._token_styles[token_type]
+        except KeyError:
+            pass
+        definition = self._style.style_for_token(token_type)
+        style = (definition['color'] or None, bool(definition['bold']), bool(definition['italic']))
+        self._token_styles[token_type] = style
+        return style
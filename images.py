@@ -0,0 +1,158 @@
+"""
+Images embedded in converted documents.
+
+Markdown images (![alt](src)) are looked up among the files bundled with the
+markdown (uploaded alongside it, or on disk for the command line). Every
+distinct image is read, downscaled if oversized and re-encoded once, on a
+shared thread pool. Pillow is optional; without it images are embedded as
+they are, provided python-docx can read their format.
+"""
+
+import hashlib
+import io
+import os
+import posixpath
+import struct
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tif', 'tiff', 'webp'}
+
+# Images are downscaled so that neither side exceeds this many pixels
+MAX_IMAGE_PIXELS = 2000
+
+JPEG_QUALITY = 85
+
+# Formats Word (and python-docx) can embed as they are
+EMBEDDABLE_FORMATS = {'PNG', 'JPEG', 'GIF', 'BMP', 'TIFF'}
+
+# Threads used to decode and resize images
+IMAGE_WORKERS = min(8, os.cpu_count() or 1)
+
+# What a document needs to show an image: relationship id of the image part,
+# its file name and display size in EMU
+ImageRef = namedtuple('ImageRef', ['rid', 'filename', 'cx', 'cy'])
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def is_image_file(filename):
+    """Check if a file name has an image extension."""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+
+def image_hash(data):
+    """Return the SHA-256 hex digest of an image's bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def resolve_image(resources, document_name, src):
+    """
+    Find the bundled file an image source refers to.
+
+    Relative sources are resolved against the directory of the referencing
+    document; if nothing matches, a file with the same base name is used,
+    since browsers upload files without their directories. Remote URLs are
+    never fetched.
+
+    Args:
+        resources: Object whose get(path) returns the bytes of a bundled
+            file (or a callable returning them), or None if there is none
+        document_name: Name of the markdown file containing the image
+        src: Image source as written in the markdown
+
+    Returns:
+        The image bytes, or None if the image is not bundled
+    """
+    parts = urlsplit(src)
+    if not src or parts.scheme or parts.netloc or not is_image_file(parts.path):
+        return None
+    path = posixpath.normpath(
+        posixpath.join(posixpath.dirname(document_name), unquote(parts.path))
+    )
+    data = resources.get(path)
+    if data is None:
+        data = resources.get(posixpath.basename(path))
+    if callable(data):
+        data = data()
+    return data
+
+
+def prepare_images(blobs):
+    """
+    Decode, downscale and re-encode images on the thread pool.
+
+    Args:
+        blobs: Dict of image_hash() to image bytes
+
+    Returns:
+        Dict of the same keys to the bytes to embed, or None for images that
+        cannot be read
+    """
+    if not blobs:
+        return {}
+    executor = _get_executor()
+    futures = {key: executor.submit(prepare_image, data) for key, data in blobs.items()}
+    return {key: future.result() for key, future in futures.items()}
+
+
+def prepare_image(data):
+    """
+    Return the bytes to embed for an image, downscaled if it is larger than
+    MAX_IMAGE_PIXELS, or None if it cannot be read.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return data if _embeddable(data) else None
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.format in EMBEDDABLE_FORMATS and max(image.size) <= MAX_IMAGE_PIXELS:
+                return data
+            image_format = image.format
+            # Lets JPEGs be decoded at a fraction of their size
+            image.draft('RGB', (MAX_IMAGE_PIXELS, MAX_IMAGE_PIXELS))
+            image.thumbnail((MAX_IMAGE_PIXELS, MAX_IMAGE_PIXELS))
+            return _encode(image, image_format)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return data if _embeddable(data) else None
+
+
+def _encode(image, image_format):
+    """Encode a Pillow image as JPEG (if it was one) or PNG."""
+    output = io.BytesIO()
+    if image_format == 'JPEG':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(output, 'JPEG', quality=JPEG_QUALITY)
+    else:
+        if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        image.save(output, 'PNG')
+    return output.getvalue()
+
+
+def _embeddable(data):
+    """Check whether python-docx can read an image's format and size."""
+    from docx.image.exceptions import UnrecognizedImageError
+    from docx.image.image import Image
+
+    try:
+        Image.from_blob(data)
+    except (UnrecognizedImageError, ValueError, IndexError, struct.error):
+        return False
+    return True
+
+
+def _get_executor():
+    """Return the shared image thread pool, creating it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='images')
+        return _executor
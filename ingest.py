@@ -0,0 +1,434 @@
+"""
+Streaming ingestion of multipart markdown uploads.
+
+The request body is decoded incrementally, so each uploaded markdown file is
+hashed, UTF-8 decoded and fed to the block lexer line by line while later
+files are still arriving. Nothing is buffered beyond the current chunk and
+line, except for files bundled with the markdown, such as images.
+"""
+
+import codecs
+import hashlib
+import posixpath
+import struct
+import tempfile
+import time
+import zlib
+from functools import partial
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from markdown_parser import BlockLexer
+
+
+CHUNK_SIZE = 64 * 1024
+MAX_FIELD_SIZE = 64 * 1024  # limit for plain (non-file) form fields
+
+# Zip archive records
+ZIP_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+ZIP_LOCAL_SIGNATURE = 0x04034b50
+ZIP_CENTRAL_SIGNATURE = 0x02014b50
+ZIP_END_SIGNATURE = 0x06054b50
+ZIP_DESCRIPTOR_SIGNATURE = 0x08074b50
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_ENCRYPTED = 0x1
+ZIP_HAS_DESCRIPTOR = 0x8
+ZIP_UTF8_NAMES = 0x800
+ZIP64_EXTRA = 0x0001
+
+
+class MarkdownUpload:
+    """
+    A markdown file being received, lexed as its bytes arrive.
+
+    The time spent decoding and lexing is accumulated in ``decode_seconds``
+    and ``lex_seconds``; ``inline_seconds`` is the part of the latter spent
+    scanning inline spans. With a ``cpu_budget`` in seconds, lexing that runs
+    over it turns the rest of the file into plain paragraphs and sets
+    ``degraded``; so does running past ``deadline``, a time.thread_time()
+    value shared by all files of a request.
+    """
+
+    def __init__(self, filename, cpu_budget=None, deadline=None):
+        self.filename = filename
+        self.size = 0
+        self.decode_seconds = 0.0
+        self.lex_seconds = 0.0
+        self._digest = hashlib.sha256()
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        if cpu_budget:
+            file_deadline = time.thread_time() + cpu_budget
+            if deadline is None or file_deadline < deadline:
+                deadline = file_deadline
+        self._lexer = BlockLexer(deadline)
+        self._partial = []  # pieces of the current, unterminated line
+
+    @property
+    def hash(self):
+        """SHA-256 hex digest of the bytes received so far."""
+        return self._digest.hexdigest()
+
+    @property
+    def inline_seconds(self):
+        """Seconds spent scanning inline spans so far."""
+        return self._lexer.inline_seconds
+
+    @property
+    def degraded(self):
+        """Whether the CPU budget ran out while lexing."""
+        return self._lexer.degraded
+
+    def write(self, data):
+        """Consume a chunk of the file's bytes."""
+        self.size += len(data)
+        self._digest.update(data)
+        started = time.perf_counter()
+        text = self._decoder.decode(data)
+        decoded = time.perf_counter()
+        self.decode_seconds += decoded - started
+        if '\n' not in text:
+            self._partial.append(text)
+            return
+
+        lines = text.split('\n')
+        self._partial.append(lines[0])
+        lines[0] = ''.join(self._partial)
+        self._partial = [lines.pop()]
+        feed = self._lexer.feed
+        for line in lines:
+            feed(line)
+        self.lex_seconds += time.perf_counter() - decoded
+
+    def close(self):
+        """Finish the file and return its parsed blocks."""
+        started = time.perf_counter()
+        self._partial.append(self._decoder.decode(b'', final=True))
+        self._lexer.feed(''.join(self._partial))
+        self._partial = []
+        blocks = self._lexer.close()
+        self.lex_seconds += time.perf_counter() - started
+        return blocks
+
+
+class ResourceUpload:
+    """A non-markdown file (e.g. an image) being received."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._chunks = []
+
+    @property
+    def hash(self):
+        """SHA-256 hex digest of the bytes received so far."""
+        return self._digest.hexdigest()
+
+    def write(self, data):
+        """Consume a chunk of the file's bytes."""
+        self.size += len(data)
+        self._digest.update(data)
+        self._chunks.append(data)
+
+    def close(self):
+        """Finish the file and return its bytes."""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_member_path(name):
+    """
+    Normalize the path of a zip member.
+
+    Returns:
+        The relative posix path, or None for directories, hidden files and
+        metadata (__MACOSX) and for paths that leave the archive root
+    """
+    path = posixpath.normpath(name.replace('\\', '/'))
+    if name.endswith('/') or path.startswith(('/', '../')) or path in ('.', '..'):
+        return None
+    if any(part.startswith(('.', '__MACOSX')) for part in path.split('/')):
+        return None
+    return path
+
+
+class ZipUpload:
+    """
+    A .zip archive being received.
+
+    Members are read from their local headers and inflated as the archive's
+    bytes arrive, without waiting for the central directory at the end, so
+    each member is handed on as soon as it is complete. Only stored and
+    deflated members are supported.
+    """
+
+    def __init__(self, filename, accept_member, on_member, max_members, max_size):
+        """
+        Args:
+            filename: Name of the archive
+            accept_member: Callable taking a member path (see
+                zip_member_path) and returning the upload object to extract
+                it into, or None to skip it
+            on_member: Called with each accepted, fully extracted member
+            max_members: Maximum number of entries in the archive
+            max_size: Maximum total uncompressed size of the members read
+        """
+        self.filename = filename
+        self.size = 0
+        self._accept_member = accept_member
+        self._on_member = on_member
+        self._max_members = max_members
+        self._max_size = max_size
+        self._members = 0
+        self._extracted = 0
+        self._buffer = bytearray()
+        self._state = self._read_header
+        self._member = None  # state of the member being read
+
+    def write(self, data):
+        """Consume a chunk of the archive's bytes."""
+        self.size += len(data)
+        self._buffer += data
+        while self._state is not None and self._state():
+            pass
+
+    def close(self):
+        """Check that the archive was complete."""
+        if self._state is not None:
+            raise BadRequest(f'Truncated zip archive: {self.filename}')
+
+    def _read_header(self):
+        """Parse a local file header; return False if more data is needed."""
+        buffer = self._buffer
+        if len(buffer) < 4:
+            return False
+        signature = struct.unpack_from('<I', buffer)[0]
+        if signature in (ZIP_CENTRAL_SIGNATURE, ZIP_END_SIGNATURE):
+            # Central directory: every member has been read
+            self._state = None
+            self._buffer = bytearray()
+            return False
+        if signature != ZIP_LOCAL_SIGNATURE:
+            raise BadRequest(f'Invalid zip archive: {self.filename}')
+        if len(buffer) < ZIP_LOCAL_HEADER.size:
+            return False
+        (_, _, flags, method, _, _, crc, compressed, size,
+         name_length, extra_length) = ZIP_LOCAL_HEADER.unpack_from(buffer)
+        end = ZIP_LOCAL_HEADER.size + name_length + extra_length
+        if len(buffer) < end:
+            return False
+
+        name = bytes(buffer[ZIP_LOCAL_HEADER.size:ZIP_LOCAL_HEADER.size + name_length])
+        extra = bytes(buffer[ZIP_LOCAL_HEADER.size + name_length:end])
+        del buffer[:end]
+
+        self._members += 1
+        if self._members > self._max_members:
+            raise RequestEntityTooLarge(f'Zip archive has more than {self._max_members} members')
+        if flags & ZIP_ENCRYPTED:
+            raise BadRequest('Encrypted zip archives are not supported')
+        if method not in (ZIP_STORED, ZIP_DEFLATED):
+            raise BadRequest('Only stored and deflated zip members are supported')
+
+        zip64 = False
+        offset = 0
+        while offset + 4 <= len(extra):
+            tag, length = struct.unpack_from('<HH', extra, offset)
+            if tag == ZIP64_EXTRA:
+                zip64 = True
+                if size == 0xFFFFFFFF and length >= 8:
+                    size = struct.unpack_from('<Q', extra, offset + 4)[0]
+                if compressed == 0xFFFFFFFF and length >= 16:
+                    compressed = struct.unpack_from('<Q', extra, offset + 12)[0]
+            offset += 4 + length
+
+        descriptor = bool(flags & ZIP_HAS_DESCRIPTOR)
+        if descriptor and method == ZIP_STORED:
+            raise BadRequest('Stored zip members with data descriptors are not supported')
+
+        name = name.decode('utf-8' if flags & ZIP_UTF8_NAMES else 'cp437', 'replace')
+        path = zip_member_path(name)
+        self._member = {
+            'upload': self._accept_member(path) if path else None,
+            'inflater': zlib.decompressobj(-zlib.MAX_WBITS) if method == ZIP_DEFLATED else None,
+            'remaining': None if descriptor else compressed,
+            'crc': crc,
+            'actual_crc': 0,
+            'descriptor': descriptor,
+            'zip64': zip64,
+        }
+        self._state = self._read_data
+        return True
+
+    def _read_data(self):
+        """Extract member data; return False if more data is needed."""
+        member = self._member
+        buffer = self._buffer
+        remaining = member['remaining']
+        take = len(buffer) if remaining is None else min(len(buffer), remaining)
+        if not take and remaining != 0:
+            return False
+        data = bytes(buffer[:take])
+        del buffer[:take]
+        if remaining is not None:
+            member['remaining'] -= take
+
+        inflater = member['inflater']
+        if inflater is None:
+            self._extract(data)
+            done = member['remaining'] == 0
+        else:
+            # Inflate in bounded steps so a zip bomb is caught early
+            output = inflater.decompress(data, CHUNK_SIZE)
+            self._extract(output)
+            while inflater.unconsumed_tail:
+                output = inflater.decompress(inflater.unconsumed_tail, CHUNK_SIZE)
+                self._extract(output)
+            done = inflater.eof
+            if done:
+                # Bytes past the end of the deflate stream belong to the next record
+                buffer[:0] = inflater.unused_data
+            elif member['remaining'] == 0:
+                raise BadRequest(f'Corrupt zip archive: {self.filename}')
+
+        if not done:
+            return False
+        self._state = self._read_descriptor if member['descriptor'] else self._finish_member
+        return True
+
+    def _read_descriptor(self):
+        """Read the data descriptor following a member's data."""
+        member = self._member
+        buffer = self._buffer
+        if len(buffer) < 4:
+            return False
+        start = 4 if struct.unpack_from('<I', buffer)[0] == ZIP_DESCRIPTOR_SIGNATURE else 0
+        length = start + (20 if member['zip64'] else 12)
+        if len(buffer) < length:
+            return False
+        member['crc'] = struct.unpack_from('<I', buffer, start)[0]
+        del buffer[:length]
+        self._state = self._finish_member
+        return True
+
+    def _finish_member(self):
+        """Verify the member's checksum and hand it on."""
+        member = self._member
+        if member['actual_crc'] != member['crc']:
+            raise BadRequest(f'Corrupt zip archive: {self.filename}')
+        self._member = None
+        self._state = self._read_header
+        if member['upload'] is not None:
+            self._on_member(member['upload'])
+        return True
+
+    def _extract(self, data):
+        """Pass uncompressed member data on, enforcing the size limit."""
+        if not data:
+            return
+        self._extracted += len(data)
+        if self._extracted > self._max_size:
+            raise RequestEntityTooLarge(f'Zip archive is larger than {self._max_size} bytes uncompressed')
+        member = self._member
+        member['actual_crc'] = zlib.crc32(data, member['actual_crc'])
+        if member['upload'] is not None:
+            member['upload'].write(data)
+
+
+class FragmentSpool:
+    """
+    Append-only store for the bytes of uploaded files, such as images, or
+    rendered body XML fragments.
+
+    Pieces stay in memory up to max_memory bytes in total and spill to a
+    temporary file beyond that.
+    """
+
+    def __init__(self, max_memory):
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+
+    def store(self, data):
+        """Append a piece and return a callable that reads it back."""
+        offset = self._file.seek(0, 2)
+        self._file.write(data)
+        return partial(self._read, offset, len(data))
+
+    def close(self):
+        """Release the spool."""
+        self._file.close()
+
+    def _read(self, offset, length):
+        self._file.seek(offset)
+        return self._file.read(length)
+
+
+def receive_uploads(stream, boundary, accept_file, on_file, max_parts=None, fields=None,
+                    max_field_size=MAX_FIELD_SIZE):
+    """
+    Decode a multipart/form-data body incrementally.
+
+    More than max_parts parts, or a plain field over max_field_size, raise
+    RequestEntityTooLarge (413).
+
+    Args:
+        stream: Readable request body stream
+        boundary: Multipart boundary (str or bytes)
+        accept_file: Callable taking (field name, filename) and returning
+            the upload object (MarkdownUpload, ResourceUpload or ZipUpload)
+            to receive the file into, or None to skip it without buffering
+        on_file: Called with each accepted, fully received upload object
+        max_parts: Optional limit on the number of parts
+        fields: Optional dict to add the plain form fields to as they
+            arrive, so callbacks can see the fields sent before a file
+        max_field_size: Limit on the size of each plain form field in bytes
+            (None = no limit)
+
+    Returns:
+        Dict of the plain form fields
+    """
+    if isinstance(boundary, str):
+        boundary = boundary.encode('latin-1')
+    decoder = MultipartDecoder(boundary, max_parts=max_parts)
+
+    if fields is None:
+        fields = {}
+    field_name = None
+    field_data = []
+    field_size = 0
+    upload = None
+
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        decoder.receive_data(chunk or None)
+        event = decoder.next_event()
+        while not isinstance(event, (Epilogue, NeedData)):
+            if isinstance(event, File):
+                field_name = None
+                upload = accept_file(event.name, event.filename or '')
+            elif isinstance(event, Field):
+                upload = None
+                field_name = event.name
+                field_data = []
+                field_size = 0
+            elif isinstance(event, Data):
+                if upload is not None:
+                    upload.write(event.data)
+                    if not event.more_data:
+                        on_file(upload)
+                        upload = None
+                elif field_name is not None:
+                    field_data.append(event.data)
+                    field_size += len(event.data)
+                    if max_field_size is not None and field_size > max_field_size:
+                        raise RequestEntityTooLarge()
+                    if not event.more_data:
+                        fields[field_name] = b''.join(field_data).decode('utf-8', 'replace')
+                        field_name = None
+            event = decoder.next_event()
+        if not chunk or isinstance(event, Epilogue):
+            break
+
+    return fields
@@ -0,0 +1,115 @@
+"""
+In-process queue for asynchronous conversion jobs.
+"""
+
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job:
+    """State of a single conversion job."""
+
+    def __init__(self, job_id, output_path, etag=None, extension='docx'):
+        self.id = job_id
+        self.output_path = output_path
+        self.etag = etag
+        self.extension = extension
+        self.status = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        """Return the job state as a JSON-serializable dict."""
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+class JobQueue:
+    """
+    Runs conversion jobs on a local thread pool.
+
+    Job state lives in memory and outputs are written to a local directory,
+    so no external services are needed. Finished jobs are forgotten and
+    their outputs deleted after ``ttl`` seconds.
+    """
+
+    def __init__(self, directory, workers=2, ttl=3600):
+        """
+        Args:
+            directory: Directory for job output files (created if missing)
+            workers: Number of jobs converted concurrently
+            ttl: Seconds a finished job and its output are kept
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='convert-job')
+        os.makedirs(directory, exist_ok=True)
+
+    def submit(self, func, etag=None, extension='docx'):
+        """
+        Queue a job.
+
+        Args:
+            func: Callable taking the output path; it writes the result there
+            etag: Optional ETag to serve the result with
+            extension: File extension of the output
+
+        Returns:
+            The new Job
+        """
+        self._expire()
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, os.path.join(self.directory, f'{job_id}.{extension}'), etag, extension)
+        with self._lock:
+            self._jobs[job_id] = job
+        self._executor.submit(self._run, job, func)
+        return job
+
+    def get(self, job_id):
+        """Return the job with the given id, or None."""
+        self._expire()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, func):
+        """Execute a job and record its outcome."""
+        job.status = RUNNING
+        try:
+            func(job.output_path)
+        except Exception as e:
+            job.error = str(e)
+            job.status = FAILED
+        else:
+            job.status = DONE
+        job.finished = time.time()
+
+    def _expire(self):
+        """Drop finished jobs older than the TTL along with their outputs."""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [
+                job for job in self._jobs.values()
+                if job.finished is not None and job.finished < cutoff
+            ]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            if os.path.exists(job.output_path):
+                os.unlink(job.output_path)
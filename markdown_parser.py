@@ -0,0 +1,466 @@
+"""
+Markdown lexer.
+
+Each source line is classified exactly once against precompiled patterns and
+folded into a flat list of lightweight block nodes. The text of paragraphs
+and list items is split into styled inline spans by a single-pass scanner.
+Output writers walk the resulting list, so parsing can be timed and cached
+independently of document building.
+"""
+
+import re
+import time
+from collections import namedtuple
+
+
+# Block nodes. Paragraphs and list items hold lists of (text, style) spans.
+# The text of IMAGE spans is an Image node instead of a string.
+Heading = namedtuple('Heading', ['level', 'text'])
+Paragraph = namedtuple('Paragraph', ['spans'])
+# language is the first word of the fence info string (```python), or None
+CodeBlock = namedtuple('CodeBlock', ['code', 'language'])
+ListBlock = namedtuple('ListBlock', ['ordered', 'items'])
+BlockQuote = namedtuple('BlockQuote', ['text'])
+HorizontalRule = namedtuple('HorizontalRule', [])
+# GFM pipe table. align holds 'left', 'center', 'right' or None per column;
+# header is a list of cells and rows a list of rows of cells, where every
+# cell is a list of spans. All rows have as many cells as the header.
+Table = namedtuple('Table', ['align', 'header', 'rows'])
+Image = namedtuple('Image', ['alt', 'src'])
+
+# Line kinds
+BLANK = 'blank'
+FENCE = 'fence'
+HEADER = 'header'
+RULE = 'rule'
+BULLET = 'bullet'
+NUMBER = 'number'
+QUOTE = 'quote'
+TEXT = 'text'
+IN_FENCE = 'in_fence'
+TABLE = 'table'
+
+HEADER_RE = re.compile(r'^(#{1,6})\s+(.+)$')
+RULE_RE = re.compile(r'^(\*{3,}|-{3,}|_{3,})\s*$')
+BULLET_RE = re.compile(r'^\s*[-*+]\s+')
+NUMBER_RE = re.compile(r'^\s*\d+\.\s+')
+QUOTE_RE = re.compile(r'^>\s*')
+TABLE_PIPE_RE = re.compile(r'(?<!\\)\|')
+TABLE_DELIMITER_RE = re.compile(r'^:?-+:?$')
+
+# Inline span styles (bit flags)
+BOLD = 1
+ITALIC = 2
+CODE = 4
+LINK = 8
+IMAGE = 16
+
+INLINE_SPECIAL_RE = re.compile(r'[`\[*_]')
+
+
+def classify_line(line):
+    """
+    Classify a single line.
+
+    Returns:
+        Tuple of (kind, value). For list items and quotes the value is the
+        line with its marker stripped, for headers it is the header match
+        (or None if the line is not a well-formed header).
+    """
+    stripped = line.strip()
+    if not stripped:
+        return BLANK, line
+    if stripped.startswith('```'):
+        return FENCE, line
+    if line.startswith('#'):
+        return HEADER, HEADER_RE.match(line)
+    if RULE_RE.match(stripped):
+        return RULE, line
+    match = BULLET_RE.match(line)
+    if match:
+        return BULLET, line[match.end():]
+    match = NUMBER_RE.match(line)
+    if match:
+        return NUMBER, line[match.end():]
+    if line.startswith('>'):
+        return QUOTE, line[QUOTE_RE.match(line).end():]
+    return TEXT, line
+
+
+def split_table_row(line):
+    """Split a pipe table row into its stripped cell texts."""
+    row = line.strip()
+    if row.startswith('|'):
+        row = row[1:]
+    if row.endswith('|') and not row.endswith('\\|'):
+        row = row[:-1]
+    return [cell.strip().replace('\\|', '|') for cell in TABLE_PIPE_RE.split(row)]
+
+
+def table_alignments(line):
+    """
+    Parse a pipe table delimiter row (| :--- | :-: | --: |).
+
+    Returns:
+        List of column alignments, or None if the line is not a delimiter row
+    """
+    align = []
+    for cell in split_table_row(line):
+        if not TABLE_DELIMITER_RE.match(cell):
+            return None
+        if cell[0] == ':':
+            align.append('center' if cell[-1] == ':' else 'left')
+        else:
+            align.append('right' if cell[-1] == ':' else None)
+    return align
+
+
+class BlockLexer:
+    """
+    Incremental block lexer.
+
+    Lines are pushed one at a time with feed(); completed blocks are appended
+    to ``blocks`` as soon as they can no longer grow. close() flushes the
+    block that is still open at the end of the input. Time spent scanning
+    inline spans is accumulated in ``inline_seconds``.
+
+    With a deadline (a time.thread_time() value), blocks completed after the
+    thread has used up its CPU time, and the block being scanned when it
+    runs out, are kept as plain text instead of being split into inline
+    spans, and ``degraded`` is set.
+    """
+
+    def __init__(self, deadline=None):
+        self.blocks = []
+        self.inline_seconds = 0.0
+        self.deadline = deadline
+        self.degraded = False
+        self._kind = None
+        self._lines = []
+        self._align = None
+        self._language = None
+
+    def feed(self, line):
+        """Consume one line of markdown (without its trailing newline)."""
+        if self._kind == IN_FENCE:
+            if line.strip().startswith('```'):
+                self.blocks.append(CodeBlock('\n'.join(self._lines), self._language))
+                self._kind = None
+                self._lines = []
+            else:
+                self._lines.append(line)
+            return
+
+        if self._kind == TEXT and '|' in line and '|' in self._lines[-1]:
+            # A delimiter row turns the last paragraph line into a table header
+            align = table_alignments(line)
+            if align and len(align) == len(split_table_row(self._lines[-1])):
+                header = self._lines.pop()
+                if self._lines:
+                    self._flush()
+                self._kind = TABLE
+                self._lines = [header]
+                self._align = align
+                return
+
+        kind, value = classify_line(line)
+
+        if self._kind is not None:
+            # Paragraphs absorb horizontal rules, tables take plain text
+            # rows, everything else only continues with lines of its own kind
+            if (kind == self._kind or (self._kind == TEXT and kind == RULE)
+                    or (self._kind == TABLE and kind == TEXT)):
+                self._lines.append(value)
+                return
+            self._flush()
+
+        if kind == FENCE:
+            self._kind = IN_FENCE
+            info = value.strip()[3:].split(None, 1)
+            self._language = info[0].lower() if info else None
+        elif kind == HEADER:
+            if value:
+                self.blocks.append(Heading(len(value.group(1)), value.group(2).strip()))
+        elif kind == RULE:
+            self.blocks.append(HorizontalRule())
+        elif kind != BLANK:
+            self._kind = kind
+            self._lines = [value]
+
+    def close(self):
+        """Flush the open block. Unterminated code fences are dropped."""
+        if self._kind is not None and self._kind != IN_FENCE:
+            self._flush()
+        self._kind = None
+        self._lines = []
+        return self.blocks
+
+    def _flush(self):
+        """Turn the collected lines into a block node."""
+        start = time.perf_counter()
+        kind = self._kind
+        deadline = self.deadline
+        if deadline is not None and not self.degraded and time.thread_time() > deadline:
+            self.degraded = True
+        if self.degraded:
+            self.blocks.append(Paragraph([('\n'.join(self._lines), 0)]))
+        elif kind == BULLET or kind == NUMBER:
+            items = [parse_inline(item, deadline) for item in self._lines]
+            self.blocks.append(ListBlock(kind == NUMBER, items))
+        elif kind == QUOTE:
+            self.blocks.append(BlockQuote(' '.join(self._lines)))
+        elif kind == TABLE:
+            self.blocks.append(self._table())
+        else:
+            self.blocks.append(Paragraph(parse_inline(' '.join(self._lines), deadline)))
+        # parse_inline gives up on a long line part way through when the
+        # time runs out, which must mark the document even if it ends here
+        if deadline is not None and not self.degraded and time.thread_time() > deadline:
+            self.degraded = True
+        self._kind = None
+        self._lines = []
+        self.inline_seconds += time.perf_counter() - start
+
+    def _table(self):
+        """Build a Table node from the collected header and body rows."""
+        columns = len(self._align)
+        deadline = self.deadline
+        rows = []
+        for i, line in enumerate(self._lines):
+            cells = split_table_row(line)[:columns]
+            cells.extend([''] * (columns - len(cells)))
+            if deadline is not None and not self.degraded and not i & 63 and time.thread_time() > deadline:
+                self.degraded = True
+            if self.degraded:
+                rows.append([[(cell, 0)] if cell else [] for cell in cells])
+            else:
+                rows.append([parse_inline(cell, deadline) for cell in cells])
+        return Table(self._align, rows[0], rows[1:])
+
+
+def parse_inline(text, deadline=None):
+    """
+    Split text into inline spans.
+
+    Code spans (`code`), links ([text](url)) and images (![alt](src)) are
+    atomic. Emphasis
+    delimiter runs of * and _ are matched against a stack of openers as soon
+    as a closer is seen, as in CommonMark, so emphasis nests (***x***,
+    **bold *and italic***). Each match uses up at least one delimiter of the
+    closing run, so a run of n delimiters makes at most n matches; openers
+    passed over by a match are dropped from the stack and a failed search is
+    not repeated, so finding them takes amortised constant time. Styles are
+    applied in one sweep at the end, and the whole scan is linear in the
+    length of text. Adjacent spans with the same style are merged.
+
+    With a deadline (a time.thread_time() value), the whole text is
+    returned as a single plain span once the thread's CPU time passes it.
+
+    Returns:
+        List of (text, style) tuples, where style is a combination of BOLD,
+        ITALIC, CODE, LINK and IMAGE. Image spans hold an Image node as
+        their text and are never merged.
+    """
+    search = INLINE_SPECIAL_RE.search
+    match = search(text)
+    if match is None:
+        return [(text, 0)] if text else []
+
+    length = len(text)
+    nodes = []           # (text, style) pairs; (char, 0) for delimiter runs
+    unmatched = {}       # node index of each delimiter run -> delimiters left
+    openers = []         # node indexes of unmatched opening runs
+    bottom = {'*': 0, '_': 0}  # openers below these indexes can't match that char
+    emphasis = []        # (opener node, closer node, style)
+    plain_start = 0
+    no_code = no_link = False
+    steps = 0
+
+    while match is not None:
+        steps += 1
+        if deadline is not None and not steps & 1023 and time.thread_time() > deadline:
+            return [(text, 0)]
+        pos = match.start()
+        char = text[pos]
+
+        if char == '`':
+            end = -1 if no_code else text.find('`', pos + 2)
+            if end < 0:
+                # No closing backtick ahead, so none of the later ones close either
+                no_code = True
+                match = search(text, pos + 1)
+                continue
+            if pos > plain_start:
+                nodes.append((text[plain_start:pos], 0))
+            nodes.append((text[pos + 1:end], CODE))
+            plain_start = end + 1
+            match = search(text, plain_start)
+            continue
+
+        if char == '[':
+            label_end = url_end = -1
+            if not no_link:
+                label_end = text.find('](', pos + 2)
+                if label_end >= 0:
+                    url_end = text.find(')', label_end + 3)
+            if url_end < 0:
+                no_link = True
+                match = search(text, pos + 1)
+                continue
+            label = text[pos + 1:label_end]
+            url = text[label_end + 2:url_end]
+            if pos > plain_start and text[pos - 1] == '!':
+                # Image; an optional "title" after the source is ignored
+                if pos - 1 > plain_start:
+                    nodes.append((text[plain_start:pos - 1], 0))
+                src = url.split(None, 1)
+                nodes.append((Image(label, src[0] if src else ''), IMAGE))
+            else:
+                if pos > plain_start:
+                    nodes.append((text[plain_start:pos], 0))
+                nodes.append((f"{label} ({url})", LINK))
+            plain_start = url_end + 1
+            match = search(text, plain_start)
+            continue
+
+        # Emphasis delimiter run
+        end = pos + 1
+        while end < length and text[end] == char:
+            end += 1
+        before = text[pos - 1] if pos > 0 else ' '
+        after = text[end] if end < length else ' '
+        can_open = not after.isspace()
+        can_close = not before.isspace()
+        if char == '_':
+            # No intraword emphasis with underscores (snake_case_names)
+            can_open = can_open and not before.isalnum()
+            can_close = can_close and not after.isalnum()
+        if not can_open and not can_close:
+            # Stays part of the surrounding plain text
+            match = search(text, end)
+            continue
+
+        if pos > plain_start:
+            nodes.append((text[plain_start:pos], 0))
+        index = len(nodes)
+        # Runs only keep a count of their unmatched delimiters; the text
+        # left of them is built once, by the sweep below
+        nodes.append((char, 0))
+        count = end - pos
+
+        while can_close and count:
+            i = len(openers) - 1
+            while i >= bottom[char] and nodes[openers[i]][0] != char:
+                i -= 1
+            if i < bottom[char]:
+                bottom[char] = len(openers)
+                break
+            opener = openers[i]
+            use = 2 if count >= 2 and unmatched[opener] >= 2 else 1
+            emphasis.append((opener, index, BOLD if use == 2 else ITALIC))
+            unmatched[opener] -= use
+            count -= use
+            # Unmatched openers inside the emphasis can no longer match
+            del openers[i + 1 if unmatched[opener] else i:]
+            for key in bottom:
+                bottom[key] = min(bottom[key], len(openers))
+
+        unmatched[index] = count
+        if can_open and count:
+            openers.append(index)
+
+        plain_start = end
+        match = search(text, end)
+
+    if plain_start < length:
+        nodes.append((text[plain_start:], 0))
+
+    # Sweep the nodes once, tracking how many bold/italic ranges are open
+    depth = {BOLD: [0] * (len(nodes) + 1), ITALIC: [0] * (len(nodes) + 1)}
+    for opener_index, closer_index, style in emphasis:
+        depth[style][opener_index + 1] += 1
+        depth[style][closer_index] -= 1
+
+    # Texts of adjacent nodes with the same style are collected and joined
+    # once; concatenating them one by one would be quadratic
+    runs = []  # [texts, style]
+    bold = italic = 0
+    for i, (node_text, style) in enumerate(nodes):
+        bold += depth[BOLD][i]
+        italic += depth[ITALIC][i]
+        if i in unmatched:
+            node_text *= unmatched[i]
+        if not node_text:
+            continue
+        if bold:
+            style |= BOLD
+        if italic:
+            style |= ITALIC
+        if runs and runs[-1][1] == style and not style & IMAGE:
+            runs[-1][0].append(node_text)
+        else:
+            runs.append([[node_text], style])
+    return [(texts[0] if style & IMAGE else ''.join(texts), style) for texts, style in runs]
+
+
+def iter_images(blocks):
+    """Yield the Image nodes of a list of blocks, in document order."""
+    for block in blocks:
+        if isinstance(block, Paragraph):
+            cells = [block.spans]
+        elif isinstance(block, ListBlock):
+            cells = block.items
+        elif isinstance(block, Table):
+            cells = [cell for row in [block.header] + block.rows for cell in row]
+        else:
+            continue
+        for spans in cells:
+            for text, style in spans:
+                if style & IMAGE:
+                    yield text
+
+
+def spans_text(spans):
+    """Return the plain text of inline spans, with images as their alt text."""
+    return ''.join(text.alt if style & IMAGE else text for text, style in spans)
+
+
+def block_text(block):
+    """Return the plain text of a block node, one line per list item or table row."""
+    if isinstance(block, Paragraph):
+        return spans_text(block.spans)
+    if isinstance(block, CodeBlock):
+        return block.code
+    if isinstance(block, ListBlock):
+        return '\n'.join(spans_text(spans) for spans in block.items)
+    if isinstance(block, Table):
+        return '\n'.join(
+            '\t'.join(spans_text(cell) for cell in row) for row in [block.header] + block.rows
+        )
+    if isinstance(block, HorizontalRule):
+        return ''
+    return block.text
+
+
+def parse_blocks(lines, lexer=None):
+    """
+    Lex an iterable of lines into a list of block nodes.
+
+    Args:
+        lines: Iterable of lines without trailing newlines
+        lexer: Optional fresh BlockLexer to use, e.g. to read its timings
+
+    Returns:
+        List of block nodes
+    """
+    if lexer is None:
+        lexer = BlockLexer()
+    feed = lexer.feed
+    for line in lines:
+        feed(line)
+    return lexer.close()
+
+
+def parse_markdown(content):
+    """Parse a markdown string into a list of block nodes."""
+    return parse_blocks(content.split('\n'))
@@ -0,0 +1,172 @@
+"""
+Conversion instrumentation.
+
+A ConversionStats object travels with each conversion and collects the wall
+time of its stages and the number of elements and bytes it produced. A
+Metrics registry aggregates finished conversions for the /metrics endpoint in
+Prometheus text format. Metrics are kept per process.
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+
+# Conversion stages, in pipeline order
+STAGES = (
+    'decode',     # UTF-8 decoding of uploads
+    'parse',      # block lexing
+    'inline',     # inline span scanning
+    'images',     # image lookup, decoding and downscaling
+    'build',      # creating document elements
+    'serialize',  # serializing body XML
+    'save',       # zipping the package
+)
+
+# Element and size counters
+COUNTS = (
+    'files',
+    'paragraphs',
+    'runs',
+    'tables',
+    'images',
+    'input_bytes',
+    'output_bytes',
+    'cached_sections',
+    'degraded_sections',
+)
+
+# Upper bounds of the conversion time histogram, in seconds
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class ConversionStats:
+    """Per-stage timings and counts of a single conversion."""
+
+    def __init__(self):
+        self.seconds = OrderedDict((stage, 0.0) for stage in STAGES)
+        self.counts = Counter()
+        self.started = time.perf_counter()
+
+    def add_time(self, stage, seconds):
+        """Add wall time to a stage."""
+        self.seconds[stage] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        """Time the body of a with statement as part of a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def count(self, name, n=1):
+        """Increase a counter."""
+        self.counts[name] += n
+
+    def count_body_xml(self, xml):
+        """Count the paragraphs, runs, tables and images in body XML bytes."""
+        counts = self.counts
+        counts['paragraphs'] += xml.count(b'<w:p>') + xml.count(b'<w:p ')
+        counts['runs'] += xml.count(b'<w:r>') + xml.count(b'<w:r ')
+        counts['tables'] += xml.count(b'<w:tbl>') + xml.count(b'<w:tbl ')
+        counts['images'] += xml.count(b'<w:drawing>')
+
+    def elapsed(self):
+        """Seconds since the conversion started."""
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Format the stage timings as a Server-Timing header value."""
+        metrics = [
+            f'{stage};dur={seconds * 1000:.1f}'
+            for stage, seconds in self.seconds.items()
+            if seconds
+        ]
+        metrics.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(metrics)
+
+    def counts_header(self):
+        """Format the counters as a header value (name=value pairs)."""
+        return ', '.join(f'{name}={self.counts[name]}' for name in COUNTS)
+
+
+class Metrics:
+    """Process-wide totals of finished conversions."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conversions = 0
+        self._failures = 0
+        self._seconds = Counter()
+        self._counts = Counter()
+        self._cache_hits = Counter()
+        self._buckets = [0] * len(DURATION_BUCKETS)
+        self._duration_sum = 0.0
+
+    def observe(self, stats, failed=False):
+        """Add a finished conversion."""
+        duration = stats.elapsed()
+        with self._lock:
+            self._conversions += 1
+            if failed:
+                self._failures += 1
+            self._seconds.update(stats.seconds)
+            self._counts.update(stats.counts)
+            self._duration_sum += duration
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    self._buckets[i] += 1
+
+    def cache_hit(self, cache):
+        """Count a request answered from a cache ('output' or 'etag')."""
+        with self._lock:
+            self._cache_hits[cache] += 1
+
+    def render(self):
+        """Return the metrics in Prometheus text exposition format."""
+        with self._lock:
+            lines = []
+
+            def metric(name, kind, help_text, samples):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{labels} {value}')
+
+            metric('md2docx_conversions_total', 'counter', 'Conversions run.',
+                   [('', self._conversions)])
+            metric('md2docx_conversion_failures_total', 'counter', 'Conversions that failed.',
+                   [('', self._failures)])
+            metric('md2docx_stage_seconds_total', 'counter', 'Wall time spent per conversion stage.',
+                   [(f'{{stage="{stage}"}}', f'{self._seconds[stage]:.6f}') for stage in STAGES])
+            metric('md2docx_elements_total', 'counter', 'Elements written to converted documents.',
+                   [(f'{{element="{name}"}}', self._counts[name])
+                    for name in ('paragraphs', 'runs', 'tables', 'images')])
+            metric('md2docx_files_total', 'counter', 'Markdown files converted.',
+                   [('', self._counts['files'])])
+            metric('md2docx_cached_sections_total', 'counter',
+                   'Converted files served from the fragment cache or a previous build.',
+                   [('', self._counts['cached_sections'])])
+            metric('md2docx_degraded_sections_total', 'counter',
+                   'Converted files partly rendered as plain text after using up their CPU budget.',
+                   [('', self._counts['degraded_sections'])])
+            metric('md2docx_input_bytes_total', 'counter', 'Markdown bytes converted.',
+                   [('', self._counts['input_bytes'])])
+            metric('md2docx_output_bytes_total', 'counter', 'Bytes of documents produced.',
+                   [('', self._counts['output_bytes'])])
+            metric('md2docx_cache_hits_total', 'counter', 'Requests answered without converting.',
+                   [(f'{{cache="{cache}"}}', self._cache_hits[cache]) for cache in ('etag', 'output')])
+
+            samples = [
+                (f'_bucket{{le="{bound}"}}', count)
+                for bound, count in zip(DURATION_BUCKETS, self._buckets)
+            ]
+            samples.append(('_bucket{le="+Inf"}', self._conversions))
+            samples.append(('_sum', f'{self._duration_sum:.6f}'))
+            samples.append(('_count', self._conversions))
+            metric('md2docx_conversion_seconds', 'histogram', 'Wall time of conversions.', samples)
+
+        return '\n'.join(lines) + '\n'
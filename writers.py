@@ -0,0 +1,639 @@
+"""
+HTML and OpenDocument output.
+
+The writers render the block nodes of the markdown_parser module, as
+MarkdownToWordConverter does, so markdown parsed once can be written in
+several formats. 'print-html' is HTML with print styles (page size, a page
+break before every source file, table headers repeated on every page) for
+turning into PDF with a browser or an HTML-to-PDF tool.
+"""
+
+import base64
+import os
+import re
+import time
+import zipfile
+from collections import namedtuple
+from contextlib import nullcontext
+from html import escape
+
+from highlight import HighlightTimeout, get_highlighter
+from images import image_hash, prepare_images, resolve_image
+from markdown_parser import (
+    BOLD, CODE, IMAGE, ITALIC, LINK,
+    BlockQuote, CodeBlock, Heading, HorizontalRule, ListBlock, Paragraph, Table,
+    iter_images, parse_markdown,
+)
+
+
+# Bump whenever the HTML or OpenDocument output changes, so cached outputs and
+# ETags from older versions are no longer used
+WRITER_VERSION = '1'
+
+OutputFormat = namedtuple('OutputFormat', ['extension', 'mimetype'])
+
+OUTPUT_FORMATS = {
+    'docx': OutputFormat(
+        'docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+    ),
+    'html': OutputFormat('html', 'text/html'),
+    'print-html': OutputFormat('print.html', 'text/html'),
+    'odt': OutputFormat('odt', 'application/vnd.oasis.opendocument.text'),
+}
+
+# Images are shrunk to the text width of a Letter page with the python-docx
+# default margins, as in Word output
+TEXT_WIDTH_EMU = 6 * 914400
+
+HTML_STYLE = """
+body { font-family: Calibri, Carlito, sans-serif; font-size: 11pt; max-width: 50em; margin: 2em auto; }
+.source { text-align: right; font-style: italic; font-size: 10pt; }
+pre { margin-left: 0.5in; font-size: 10pt; white-space: pre-wrap; }
+code { font-family: 'Courier New', monospace; }
+blockquote { margin: 0 0.5in; font-style: italic; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #000; padding: 0.2em 0.5em; vertical-align: top; }
+.link { text-decoration: underline; }
+img { max-width: 100%; vertical-align: bottom; }
+"""
+
+PRINT_STYLE = """
+@page { size: letter; margin: 1in 1.25in; }
+body { max-width: none; margin: 0; }
+section + section { break-before: page; }
+h1, h2, h3, h4, h5, h6 { break-after: avoid; }
+pre, blockquote, tr, img { break-inside: avoid; }
+thead { display: table-header-group; }
+"""
+
+ODT_MIMETYPE = OUTPUT_FORMATS['odt'].mimetype
+
+ODF_NAMESPACES = (
+    'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0"'
+    ' xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0"'
+    ' xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0"'
+    ' xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0"'
+    ' xmlns:draw="urn:oasis:names:tc:opendocument:xmlns:drawing:1.0"'
+    ' xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:xsl-fo-compatible:1.0"'
+    ' xmlns:svg="urn:oasis:names:tc:opendocument:xmlns:svg-compatible:1.0"'
+    ' xmlns:xlink="http://www.w3.org/1999/xlink"'
+)
+
+# Named styles of ODT output; page setup and fonts follow the Word output
+ODT_STYLES = f"""<?xml version="1.0" encoding="UTF-8"?>
+<office:document-styles {ODF_NAMESPACES} office:version="1.3">
+<office:styles>
+<style:default-style style:family="paragraph">
+<style:paragraph-properties fo:margin-bottom="0.14in"/>
+<style:text-properties fo:font-family="Calibri" fo:font-size="11pt"/>
+</style:default-style>
+<style:style style:name="Standard" style:family="paragraph" style:class="text"/>
+<style:style style:name="Heading" style:family="paragraph" style:parent-style-name="Standard" style:class="text">
+<style:paragraph-properties fo:margin-top="0.17in" fo:keep-with-next="always"/>
+<style:text-properties fo:font-weight="bold" fo:color="#365F91"/>
+</style:style>
+{''.join(
+    f'<style:style style:name="Heading_20_{level}" style:display-name="Heading {level}"'
+    f' style:family="paragraph" style:parent-style-name="Heading" style:default-outline-level="{level}">'
+    f'<style:text-properties fo:font-size="{size}pt"/></style:style>'
+    for level, size in zip(range(1, 7), (14, 13, 12, 11, 11, 11))
+)}
+<style:style style:name="Source" style:family="paragraph" style:parent-style-name="Standard">
+<style:paragraph-properties fo:text-align="end"/>
+<style:text-properties fo:font-style="italic" fo:font-size="10pt"/>
+</style:style>
+<style:style style:name="Preformatted_20_Text" style:display-name="Preformatted Text" style:family="paragraph" style:parent-style-name="Standard">
+<style:paragraph-properties fo:margin-left="0.5in"/>
+<style:text-properties fo:font-family="'Courier New'" fo:font-size="10pt"/>
+</style:style>
+<style:style style:name="Quotations" style:family="paragraph" style:parent-style-name="Standard">
+<style:paragraph-properties fo:margin-left="0.5in" fo:margin-right="0.5in"/>
+<style:text-properties fo:font-style="italic"/>
+</style:style>
+<style:style style:name="List_20_Contents" style:display-name="List Contents" style:family="paragraph" style:parent-style-name="Standard"/>
+<style:style style:name="Table_20_Contents" style:display-name="Table Contents" style:family="paragraph" style:parent-style-name="Standard">
+<style:paragraph-properties fo:margin-bottom="0in"/>
+</style:style>
+<text:list-style style:name="List_20_Bullet" style:display-name="List Bullet">
+<text:list-level-style-bullet text:level="1" text:bullet-char="•">
+<style:list-level-properties text:list-level-position-and-space-mode="label-alignment">
+<style:list-level-label-alignment text:label-followed-by="listtab" text:list-tab-stop-position="0.25in" fo:text-indent="-0.25in" fo:margin-left="0.25in"/>
+</style:list-level-properties>
+</text:list-level-style-bullet>
+</text:list-style>
+<text:list-style style:name="List_20_Number" style:display-name="List Number">
+<text:list-level-style-number text:level="1" style:num-suffix="." style:num-format="1">
+<style:list-level-properties text:list-level-position-and-space-mode="label-alignment">
+<style:list-level-label-alignment text:label-followed-by="listtab" text:list-tab-stop-position="0.25in" fo:text-indent="-0.25in" fo:margin-left="0.25in"/>
+</style:list-level-properties>
+</text:list-level-style-number>
+</text:list-style>
+</office:styles>
+<office:automatic-styles>
+<style:page-layout style:name="Letter">
+<style:page-layout-properties fo:page-width="8.5in" fo:page-height="11in" fo:margin-top="1in" fo:margin-bottom="1in" fo:margin-left="1.25in" fo:margin-right="1.25in"/>
+</style:page-layout>
+</office:automatic-styles>
+<office:master-styles>
+<style:master-page style:name="Standard" style:page-layout-name="Letter"/>
+</office:master-styles>
+</office:document-styles>
+"""
+
+# Automatic text style names of the ODT inline span styles
+ODT_TEXT_STYLES = {style: f'T{style}' for style in range(1, 16)}
+
+# Whitespace ODF would collapse: newlines, tabs, spaces at the start of a
+# line and runs of spaces
+ODF_WHITESPACE_RE = re.compile(r'\n|\t|(?:^|(?<=\n)) +| {2,}')
+
+
+def _display_name(filename):
+    """Return a source file name without its extension, as shown in headers."""
+    return filename.rsplit('.', 1)[0] if '.' in filename else filename
+
+
+def _open_output(output):
+    """Open a path for binary writing, or pass a file object through."""
+    if isinstance(output, (str, os.PathLike)):
+        return open(output, 'wb')
+    return nullcontext(output)
+
+
+def _image_info(blob):
+    """Return the (content type, extension, width, height in EMU) of an image."""
+    from docx.image.image import Image
+
+    image = Image.from_blob(blob)
+    cx, cy = image.width, image.height
+    if cx > TEXT_WIDTH_EMU:
+        cx, cy = TEXT_WIDTH_EMU, cy * TEXT_WIDTH_EMU // cx
+    return image.content_type, image.ext, int(cx), int(cy)
+
+
+def _code_css(style):
+    """Return the inline CSS of a (color, bold, italic) code token style."""
+    color, bold, italic = style
+    rules = []
+    if color:
+        rules.append(f'color:#{color.lstrip("#")}')
+    if bold:
+        rules.append('font-weight:bold')
+    if italic:
+        rules.append('font-style:italic')
+    return ';'.join(rules)
+
+
+def _odf_text(text):
+    """Escape text for ODF, keeping the whitespace ODF would collapse."""
+    def replace(match):
+        whitespace = match.group()
+        if whitespace == '\n':
+            return '<text:line-break/>'
+        if whitespace == '\t':
+            return '<text:tab/>'
+        start = match.start()
+        if start == 0 or match.string[start - 1] == '\n':
+            return f'<text:s text:c="{len(whitespace)}"/>'
+        return f' <text:s text:c="{len(whitespace) - 1}"/>'
+    return ODF_WHITESPACE_RE.sub(replace, escape(text, quote=False))
+
+
+def _odf_text_properties(style):
+    """Return the <style:text-properties> attributes for an inline span style."""
+    properties = []
+    if style & CODE:
+        properties.append('fo:font-family="\'Courier New\'"')
+    if style & BOLD:
+        properties.append('fo:font-weight="bold"')
+    if style & ITALIC:
+        properties.append('fo:font-style="italic"')
+    if style & LINK:
+        properties.append(
+            'style:text-underline-style="solid" style:text-underline-width="auto"'
+            ' style:text-underline-color="font-color"'
+        )
+    return ' '.join(properties)
+
+
+class _Writer:
+    """Parts shared by the HTML and ODT writers."""
+
+    def __init__(self, highlight_style='default', stats=None):
+        """
+        Args:
+            highlight_style: Pygments style for code blocks with a fence
+                language, or None to render all code plain
+            stats: Optional ConversionStats to record timings into
+        """
+        self.highlighter = get_highlighter(highlight_style) if highlight_style else None
+        self.stats = stats
+        # Whether a code block of the last document was left plain because
+        # highlighting it ran out of time
+        self.degraded = False
+
+    def write(self, markdown_files, output, resources=None):
+        """
+        Write markdown files as a single document.
+
+        Args:
+            markdown_files: List of dicts with a 'filename' key and either
+                'blocks' (parsed by the markdown_parser module) or 'content'
+            output: Path or writable binary file object
+            resources: Optional object whose get(path) returns the bytes of a
+                file bundled with the markdown, as for
+                MarkdownToWordConverter.convert()
+        """
+        self.degraded = False
+        sections = []
+        for md_file in markdown_files:
+            blocks = md_file.get('blocks')
+            if blocks is None:
+                if 'content' not in md_file:
+                    raise ValueError(f"{md_file['filename']} has neither blocks nor content")
+                blocks = parse_markdown(md_file['content'])
+            sections.append((md_file['filename'], blocks))
+
+        started = time.perf_counter()
+        if resources is None:
+            images = [{} for _ in sections]
+        else:
+            images = self._bundled_images(sections, resources)
+        self._add_time('images', time.perf_counter() - started)
+
+        started = time.perf_counter()
+        with _open_output(output) as f:
+            self._write(sections, images, f)
+            if self.stats is not None:
+                self.stats.count('output_bytes', f.tell())
+        self._add_time('build', time.perf_counter() - started)
+        if self.degraded and self.stats is not None:
+            # Keeps the output out of the output cache
+            self.stats.count('degraded_sections')
+
+    def _add_time(self, stage, seconds):
+        """Record time spent in a stage, if stats are being kept."""
+        if self.stats is not None:
+            self.stats.add_time(stage, seconds)
+
+    def _bundled_images(self, sections, resources):
+        """
+        Prepare every distinct image of the sections that is found in
+        resources once.
+
+        Returns:
+            List with a dict of image source to _add_image() result per section
+        """
+        found = []
+        blobs = {}
+        for filename, blocks in sections:
+            sources = {}
+            for image in iter_images(blocks):
+                if image.src in sources:
+                    continue
+                data = resolve_image(resources, filename, image.src)
+                if data is not None:
+                    sources[image.src] = image_hash(data)
+                    blobs.setdefault(sources[image.src], data)
+            found.append(sources)
+
+        refs = {
+            digest: self._add_image(digest, blob)
+            for digest, blob in prepare_images(blobs).items()
+            if blob is not None
+        }
+        return [
+            {src: refs[digest] for src, digest in sources.items() if digest in refs}
+            for sources in found
+        ]
+
+    def _highlight(self, block):
+        """Return the highlighted spans of a code block, or None."""
+        if self.highlighter is None:
+            return None
+        try:
+            return self.highlighter.highlight(block.code, block.language)
+        except HighlightTimeout:
+            self.degraded = True
+            return None
+
+    def _add_image(self, digest, blob):
+        """Take a prepared image and return what the output refers to it by."""
+        raise NotImplementedError
+
+    def _write(self, sections, images, f):
+        """Write the (filename, blocks) sections and their images to f."""
+        raise NotImplementedError
+
+
+class HtmlWriter(_Writer):
+    """Writes a standalone HTML document, with images inlined as data URIs."""
+
+    def __init__(self, highlight_style='default', print_ready=False, stats=None):
+        """
+        Args:
+            highlight_style: As for _Writer
+            print_ready: Add print styles for conversion to PDF
+            stats: As for _Writer
+        """
+        super().__init__(highlight_style, stats)
+        self.print_ready = print_ready
+
+    def _add_image(self, digest, blob):
+        content_type = _image_info(blob)[0]
+        return f'data:{content_type};base64,{base64.b64encode(blob).decode("ascii")}'
+
+    def _write(self, sections, images, f):
+        style = HTML_STYLE + (PRINT_STYLE if self.print_ready else '')
+        f.write(
+            '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+            f'<title>Combined document</title>\n<style>{style}</style>\n</head>\n<body>\n'
+            .encode('utf-8')
+        )
+        for (filename, blocks), section_images in zip(sections, images):
+            self._images = section_images
+            parts = [
+                '<section>\n',
+                f'<p class="source">Source: {escape(_display_name(filename), quote=False)}</p>\n<hr>\n',
+            ]
+            parts.extend(self._block(block) for block in blocks)
+            parts.append('</section>\n')
+            f.write(''.join(parts).encode('utf-8'))
+        f.write(b'</body>\n</html>\n')
+
+    def _block(self, block):
+        """Return the HTML of a block node."""
+        kind = type(block)
+        if kind is Paragraph:
+            return f'<p>{self._spans(block.spans)}</p>\n'
+        if kind is Heading:
+            level = min(block.level, 6)
+            return f'<h{level}>{escape(block.text, quote=False)}</h{level}>\n'
+        if kind is CodeBlock:
+            return self._code_block(block)
+        if kind is ListBlock:
+            tag = 'ol' if block.ordered else 'ul'
+            items = ''.join(f'<li>{self._spans(spans)}</li>\n' for spans in block.items)
+            return f'<{tag}>\n{items}</{tag}>\n'
+        if kind is BlockQuote:
+            return f'<blockquote><p>{escape(block.text, quote=False)}</p></blockquote>\n'
+        if kind is HorizontalRule:
+            return '<hr>\n'
+        if kind is Table:
+            return self._table(block)
+        raise TypeError(f'Unknown block node {kind.__name__}')
+
+    def _spans(self, spans):
+        """Return the HTML of a list of inline spans."""
+        parts = []
+        for text, style in spans:
+            if style & IMAGE:
+                src = self._images.get(text.src)
+                if src is None:
+                    parts.append(self._spans([(text.alt or text.src, style & ~IMAGE)]))
+                else:
+                    parts.append(f'<img src="{src}" alt="{escape(text.alt)}">')
+                continue
+            html = escape(text, quote=False)
+            if style & CODE:
+                html = f'<code>{html}</code>'
+            if style & LINK:
+                html = f'<span class="link">{html}</span>'
+            if style & ITALIC:
+                html = f'<em>{html}</em>'
+            if style & BOLD:
+                html = f'<strong>{html}</strong>'
+            parts.append(html)
+        return ''.join(parts)
+
+    def _code_block(self, block):
+        """Return the HTML of a code block, highlighted if possible."""
+        language = f' class="language-{escape(block.language)}"' if block.language else ''
+        spans = self._highlight(block)
+        if spans:
+            code = ''.join(
+                f'<span style="{_code_css(style)}">{escape(text, quote=False)}</span>'
+                if _code_css(style) else escape(text, quote=False)
+                for text, style in spans
+            )
+        else:
+            code = escape(block.code, quote=False)
+        return f'<pre><code{language}>{code}</code></pre>\n'
+
+    def _table(self, table):
+        """Return the HTML of a table."""
+        styles = [f' style="text-align:{align}"' if align else '' for align in table.align]
+        parts = ['<table>\n<thead>\n<tr>']
+        for style, cell in zip(styles, table.header):
+            parts.append(f'<th{style}>{self._spans(cell)}</th>')
+        parts.append('</tr>\n</thead>\n<tbody>\n')
+        for row in table.rows:
+            parts.append('<tr>')
+            for style, cell in zip(styles, row):
+                parts.append(f'<td{style}>{self._spans(cell)}</td>')
+            parts.append('</tr>\n')
+        parts.append('</tbody>\n</table>\n')
+        return ''.join(parts)
+
+
+class OdtWriter(_Writer):
+    """Writes an OpenDocument text (.odt) package."""
+
+    def _add_image(self, digest, blob):
+        content_type, ext, cx, cy = _image_info(blob)
+        path = f'Pictures/{digest[:16]}.{ext}'
+        self._pictures.append((path, content_type, blob))
+        return path, cx, cy
+
+    def write(self, markdown_files, output, resources=None):
+        """Write markdown files as a single .odt; see _Writer.write()."""
+        self._pictures = []
+        self._tables = 0
+        self._frames = 0
+        super().write(markdown_files, output, resources)
+
+    def _write(self, sections, images, f):
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as package:
+            # The mimetype must come first and uncompressed
+            package.writestr('mimetype', ODT_MIMETYPE, compress_type=zipfile.ZIP_STORED)
+            package.writestr('styles.xml', ODT_STYLES)
+
+            with package.open('content.xml', 'w') as part:
+                part.write(self._content_head(sections).encode('utf-8'))
+                for i, ((filename, blocks), section_images) in enumerate(zip(sections, images)):
+                    self._images = section_images
+                    parts = [
+                        f'<text:p text:style-name="{"SourceBreak" if i else "Source"}">'
+                        f'Source: {_odf_text(_display_name(filename))}</text:p>',
+                        f'<text:p text:style-name="Standard">{"─" * 50}</text:p>',
+                    ]
+                    parts.extend(self._block(block) for block in blocks)
+                    part.write(''.join(parts).encode('utf-8'))
+                part.write(b'</office:text></office:body></office:document-content>')
+
+            for path, _, blob in self._pictures:
+                package.writestr(path, blob, compress_type=zipfile.ZIP_STORED)
+            package.writestr('META-INF/manifest.xml', self._manifest())
+
+    def _content_head(self, sections):
+        """
+        Return content.xml up to the start of the body, declaring the text
+        styles of all highlighted code up front.
+        """
+        self._code_styles = {}
+        for _, blocks in sections:
+            for block in blocks:
+                if isinstance(block, CodeBlock):
+                    for _, style in self._highlight(block) or ():
+                        self._code_styles.setdefault(style, f'C{len(self._code_styles) + 1}')
+
+        styles = [
+            f'<style:style style:name="{name}" style:family="text">'
+            f'<style:text-properties {_odf_text_properties(style)}/></style:style>'
+            for style, name in ODT_TEXT_STYLES.items()
+        ]
+        for (color, bold, italic), name in self._code_styles.items():
+            properties = '' if not color else f' fo:color="#{color.lstrip("#")}"'
+            properties += ' fo:font-weight="bold"' if bold else ''
+            properties += ' fo:font-style="italic"' if italic else ''
+            styles.append(
+                f'<style:style style:name="{name}" style:family="text">'
+                f'<style:text-properties{properties}/></style:style>'
+            )
+        styles.append(
+            '<style:style style:name="SourceBreak" style:family="paragraph" style:parent-style-name="Source">'
+            '<style:paragraph-properties fo:break-before="page"/></style:style>'
+        )
+        for align, value in (('left', 'start'), ('center', 'center'), ('right', 'end')):
+            styles.append(
+                f'<style:style style:name="Cell_{align}" style:family="paragraph"'
+                ' style:parent-style-name="Table_20_Contents">'
+                f'<style:paragraph-properties fo:text-align="{value}"/></style:style>'
+            )
+        styles.append(
+            '<style:style style:name="Grid" style:family="table">'
+            '<style:table-properties table:align="margins"/></style:style>'
+            '<style:style style:name="GridCell" style:family="table-cell">'
+            '<style:table-cell-properties fo:border="0.5pt solid #000000" fo:padding="0.04in"/></style:style>'
+            '<style:style style:name="Picture" style:family="graphic">'
+            '<style:graphic-properties style:vertical-pos="top" style:vertical-rel="baseline"/></style:style>'
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<office:document-content {ODF_NAMESPACES} office:version="1.3">'
+            f'<office:automatic-styles>{"".join(styles)}</office:automatic-styles>'
+            '<office:body><office:text>'
+        )
+
+    def _manifest(self):
+        """Return META-INF/manifest.xml listing the package parts."""
+        entries = [
+            f'<manifest:file-entry manifest:full-path="/" manifest:version="1.3" manifest:media-type="{ODT_MIMETYPE}"/>',
+            '<manifest:file-entry manifest:full-path="content.xml" manifest:media-type="text/xml"/>',
+            '<manifest:file-entry manifest:full-path="styles.xml" manifest:media-type="text/xml"/>',
+        ]
+        entries.extend(
+            f'<manifest:file-entry manifest:full-path="{path}" manifest:media-type="{content_type}"/>'
+            for path, content_type, _ in self._pictures
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0"'
+            f' manifest:version="1.3">{"".join(entries)}</manifest:manifest>'
+        )
+
+    def _block(self, block):
+        """Return the content.xml markup of a block node."""
+        kind = type(block)
+        if kind is Paragraph:
+            return f'<text:p text:style-name="Standard">{self._spans(block.spans)}</text:p>'
+        if kind is Heading:
+            level = min(block.level, 6)
+            return (
+                f'<text:h text:style-name="Heading_20_{level}" text:outline-level="{level}">'
+                f'{_odf_text(block.text)}</text:h>'
+            )
+        if kind is CodeBlock:
+            return self._code_block(block)
+        if kind is ListBlock:
+            items = ''.join(
+                '<text:list-item><text:p text:style-name="List_20_Contents">'
+                f'{self._spans(spans)}</text:p></text:list-item>'
+                for spans in block.items
+            )
+            list_style = 'List_20_Number' if block.ordered else 'List_20_Bullet'
+            return f'<text:list text:style-name="{list_style}">{items}</text:list>'
+        if kind is BlockQuote:
+            return f'<text:p text:style-name="Quotations">{_odf_text(block.text)}</text:p>'
+        if kind is HorizontalRule:
+            return f'<text:p text:style-name="Standard">{"─" * 50}</text:p>'
+        if kind is Table:
+            return self._table(block)
+        raise TypeError(f'Unknown block node {kind.__name__}')
+
+    def _spans(self, spans, extra_style=0):
+        """Return the ODF markup of a list of inline spans."""
+        parts = []
+        for text, style in spans:
+            style |= extra_style
+            if style & IMAGE:
+                ref = self._images.get(text.src)
+                if ref is None:
+                    parts.append(self._spans([(text.alt or text.src, style & ~IMAGE)]))
+                else:
+                    parts.append(self._frame(text, ref))
+                continue
+            if style:
+                parts.append(
+                    f'<text:span text:style-name="{ODT_TEXT_STYLES[style]}">{_odf_text(text)}</text:span>'
+                )
+            else:
+                parts.append(_odf_text(text))
+        return ''.join(parts)
+
+    def _frame(self, image, ref):
+        """Return the <draw:frame> of an inline image."""
+        path, cx, cy = ref
+        self._frames += 1
+        title = f'<svg:title>{escape(image.alt, quote=False)}</svg:title>' if image.alt else ''
+        return (
+            f'<draw:frame draw:style-name="Picture" draw:name="Image{self._frames}"'
+            ' text:anchor-type="as-char"'
+            f' svg:width="{cx / 914400:.4f}in" svg:height="{cy / 914400:.4f}in">'
+            f'<draw:image xlink:href="{path}" xlink:type="simple" xlink:show="embed"'
+            f' xlink:actuate="onLoad"/>{title}</draw:frame>'
+        )
+
+    def _code_block(self, block):
+        """Return the ODF markup of a code block, highlighted if possible."""
+        spans = self._highlight(block)
+        # A block that timed out while the styles were collected has none
+        if spans and all(style in self._code_styles for _, style in spans):
+            code = ''.join(
+                f'<text:span text:style-name="{self._code_styles[style]}">{_odf_text(text)}</text:span>'
+                for text, style in spans
+            )
+        else:
+            code = _odf_text(block.code)
+        return f'<text:p text:style-name="Preformatted_20_Text">{code}</text:p>'
+
+    def _table(self, table):
+        """Return the ODF markup of a table with a repeated, bold header row."""
+        self._tables += 1
+        cell_styles = [f'Cell_{align or "left"}' for align in table.align]
+
+        def row_markup(cells, extra_style):
+            return '<table:table-row>' + ''.join(
+                '<table:table-cell table:style-name="GridCell" office:value-type="string">'
+                f'<text:p text:style-name="{style}">{self._spans(cell, extra_style)}</text:p>'
+                '</table:table-cell>'
+                for style, cell in zip(cell_styles, cells)
+            ) + '</table:table-row>'
+
+        return (
+            f'<table:table table:name="Table{self._tables}" table:style-name="Grid">'
+            f'<table:table-column table:number-columns-repeated="{len(table.align)}"/>'
+            f'<table:table-header-rows>{row_markup(table.header, BOLD)}</table:table-header-rows>'
+            + ''.join(row_markup(row, 0) for row in table.rows)
+            + '</table:table>'
+        )